@@ -1,50 +1,102 @@
 # Flask imports
-from flask import Flask, request, jsonify, Response, send_file  # ← ДОБАВЬТЕ send_file
+from flask import Flask, request, jsonify, Response, send_file, g, has_request_context  # ← ДОБАВЬТЕ send_file
 import logging
-from threading import Thread
+from threading import Thread, Lock
 import time
 
 # Другие импорты
 import sqlite3
 import pandas as pd
-from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
+from datetime import datetime, date, timedelta, timezone
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, WebAppInfo
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import os
 import json
-import tempfile
+import base64
 import re
 import io
 import subprocess
-from PIL import Image, ImageEnhance, ImageFilter
-import speech_recognition as sr
-import numpy as np
 import psycopg2
-from urllib.parse import urlparse
-import random
-import string
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
+from urllib.parse import urlparse, parse_qsl
+import orjson
 from flask_cors import CORS
+from flask.json.provider import JSONProvider
+from werkzeug.http import http_date
+from decimal import Decimal
+import uuid
+import importlib.util
 import hashlib
 import hmac
 import asyncio
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 # Настройка логирования
+# LOG_LEVEL=WARNING в продакшене отключает INFO-строки на горячих путях
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper()
 )
 logger = logging.getLogger(__name__)
 
+# JSON-ответы API сериализуются orjson
+_ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME
+
+def _orjson_default(obj):
+    """Типы вне orjson - в том же виде, что и у стандартного провайдера Flask"""
+    if isinstance(obj, (datetime, date)):
+        return http_date(obj)
+    if isinstance(obj, (Decimal, uuid.UUID)):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class OrjsonProvider(JSONProvider):
+    """JSON-провайдер Flask на orjson: jsonify() работает без изменений в обработчиках"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_orjson_default, option=_ORJSON_OPTIONS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=_orjson_default, option=_ORJSON_OPTIONS),
+            mimetype='application/json'
+        )
+
 # Flask app для API
 flask_app = Flask(__name__)
+flask_app.json = OrjsonProvider(flask_app)
 CORS(flask_app)
 
 # ===== КОНФИГУРАЦИЯ =====
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '7911885739:AAGrMekWmLgz_ej8JDFqG-CbDA5Nie7vKFc')
 WEB_APP_URL = os.environ.get('WEB_APP_URL', 'https://web-production-4c423.up.railway.app/webapp')
 DEV_MODE = os.environ.get('DEV_MODE', 'False').lower() == 'true'  # Режим разработки
+DATABASE_URL = os.environ.get('DATABASE_URL')
+PORT = int(os.environ.get('PORT', 5000))  # Порт Flask API
+# Публичный адрес для webhook; без него бот получает обновления через polling
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))  # PORT занят Flask API
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# Сколько обновлений бот обрабатывает одновременно (OCR и распознавание речи не блокируют остальных)
+CONCURRENT_UPDATES = 256
+# Очередь входящих обновлений ограничена: при всплеске webhook ждет, а не копит память
+UPDATE_QUEUE_SIZE = 512
+# Все обработчики работают с обычными сообщениями - остальные типы Telegram не присылает
+ALLOWED_UPDATES = [Update.MESSAGE]
+# Распознавание чеков и голосовых можно выключить: обработчик сразу отвечает, ничего не скачивая
+ENABLE_PHOTO_OCR = os.environ.get('ENABLE_PHOTO_OCR', '1') == '1'
+ENABLE_VOICE = os.environ.get('ENABLE_VOICE', '1') == '1'
+
+# Клавиатура с кнопкой Web App одинакова для всех сообщений - собираем один раз
+WEB_APP_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("📊 Открыть финансовый трекер", web_app=WebAppInfo(url=WEB_APP_URL))]
+], resize_keyboard=True)
 
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не найден в переменных окружения!")
@@ -58,15 +110,10 @@ DAILY_REPORT_HOUR = 20  # Время отправки ежедневного о
 def test_postgresql_connection():
     """Тестирование подключения к PostgreSQL"""
     try:
-        if 'DATABASE_URL' in os.environ:
-            conn = get_db_connection()
-            if conn and not isinstance(conn, sqlite3.Connection):
+        if DATABASE_URL is not None:
+            with get_db_connection():
                 logger.info("✅ PostgreSQL подключение успешно")
-                conn.close()
-                return True
-            else:
-                logger.warning("⚠️ Используется SQLite вместо PostgreSQL")
-                return False
+            return True
         else:
             logger.warning("⚠️ DATABASE_URL не найден, используется SQLite")
             return False
@@ -80,15 +127,13 @@ test_postgresql_connection()
 # Убедись что миграции работают правильно
 def migrate_from_sqlite_to_postgresql():
     """Миграция данных из SQLite в PostgreSQL если нужно"""
-    if 'DATABASE_URL' not in os.environ:
+    if DATABASE_URL is None:
         return
     
+    conn_pg = None
     try:
         # Проверяем, есть ли данные в PostgreSQL
         conn_pg = get_db_connection()
-        if isinstance(conn_pg, sqlite3.Connection):
-            return  # Это SQLite, не мигрируем
-            
         cursor_pg = conn_pg.cursor()
         
         # Проверяем, есть ли уже данные
@@ -97,7 +142,6 @@ def migrate_from_sqlite_to_postgresql():
         
         if count > 0:
             logger.info("✅ В PostgreSQL уже есть данные, миграция не нужна")
-            conn_pg.close()
             return
         
         # Проверяем, есть ли данные в SQLite
@@ -117,7 +161,7 @@ def migrate_from_sqlite_to_postgresql():
                 ''', space)
             
             # Мигрируем участников
-            cursor_sqlite.execute("SELECT * FROM space_members")
+            cursor_sqlite.execute("SELECT id, space_id, user_id, user_name, role, joined_at FROM space_members")
             members = cursor_sqlite.fetchall()
             
             for member in members:
@@ -140,10 +184,11 @@ def migrate_from_sqlite_to_postgresql():
             conn_sqlite.close()
             logger.info("✅ Миграция данных из SQLite в PostgreSQL завершена")
         
-        conn_pg.close()
-        
     except Exception as e:
         logger.error(f"❌ Ошибка миграции: {e}")
+    finally:
+        if conn_pg is not None:
+            conn_pg.close()
 
 
 # ===== ВАЖНО: ДОБАВЬТЕ МАРШРУТЫ ПОСЛЕ СОЗДАНИЯ flask_app =====
@@ -167,31 +212,45 @@ def webapp():
     return send_file('index.html')
 
 # ===== УЛУЧШЕННАЯ ВАЛИДАЦИЯ WEBAPP DATA =====
+# Ключ проверки подписи initData зависит только от токена - вычисляем один раз
+_WEBAPP_SECRET_KEY = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+# Срок жизни подписанного initData: без него перехваченная строка действует вечно
+WEBAPP_AUTH_MAX_AGE = int(os.environ.get('WEBAPP_AUTH_MAX_AGE', 86400))  # секунды
+
 def validate_webapp_data(init_data):
-    """Улучшенная валидация данных от Telegram WebApp"""
+    """Проверка подписи initData от Telegram WebApp (HMAC-SHA256)"""
+    if DEV_MODE:
+        # В режиме разработки initData может быть пустым или поддельным
+        return True
+    
+    if not init_data:
+        logger.warning("❌ Пустые данные WebApp")
+        return False
+    
     try:
-        # Всегда логируем что приходит
-        logger.info(f"🔐 Получены WebApp данные: '{init_data}'")
-        
-        # Если данные пустые, но мы в продакшене - отклоняем
-        if not init_data or init_data == '':
-            logger.warning("❌ Пустые данные WebApp")
-            # Временно разрешаем для отладки
-            logger.warning("⚠️ Временно разрешаем пустые данные для отладки")
-            return True
-            
-        # Базовая проверка формата
-        if 'user=' not in init_data:
-            logger.warning("❌ Отсутствует поле user в WebApp данных")
+        # Пустые поля тоже входят в подписанную строку - не теряем их
+        params = dict(parse_qsl(init_data, keep_blank_values=True))
+        received_hash = params.pop('hash', None)
+        if not received_hash:
+            logger.warning("❌ Отсутствует подпись в WebApp данных")
+            return False
+        
+        data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(params.items()))
+        expected_hash = hmac.new(_WEBAPP_SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected_hash, received_hash):
+            logger.warning("❌ Неверная подпись WebApp данных")
+            return False
+        
+        auth_date = int(params.get('auth_date', 0))
+        if time.time() - auth_date > WEBAPP_AUTH_MAX_AGE:
+            logger.warning("❌ Устаревшие WebApp данные")
             return False
         
-        logger.info("✅ WebApp данные прошли базовую валидацию")
         return True
         
     except Exception as e:
         logger.error(f"❌ Ошибка валидации WebApp данных: {e}")
-        # Временно разрешаем для отладки
-        return True
+        return False
 
 def get_user_from_init_data(init_data):
     """Извлечение данных пользователя из initData с улучшенной обработкой"""
@@ -209,44 +268,25 @@ def get_user_from_init_data(init_data):
             
         logger.info(f"🔍 Парсим initData: {init_data[:200]}...")
         
-        params = {}
-        for item in init_data.split('&'):
-            if '=' in item:
-                key, value = item.split('=', 1)
-                # Декодируем URL-encoded значения
-                try:
-                    params[key] = value
-                except:
-                    params[key] = value
-        
+        # parse_qsl сам раскодирует URL-encoding всех полей
+        params = dict(parse_qsl(init_data))
         logger.info(f"📋 Найдены параметры: {list(params.keys())}")
         
-        if 'user' in params:
-            user_data_str = params['user']
-            # СНАЧАЛА декодируем URL-encoding, ПОТОМ JSON
-            try:
-                user_data_str_decoded = user_data_str.replace('%22', '"').replace('%7B', '{').replace('%7D', '}').replace('%2C', ',').replace('%3A', ':')
-                user_data = json.loads(user_data_str_decoded)
-            except:
-                # Если не получается, пробуем как есть
-                try:
-                    user_data = json.loads(user_data_str)
-                except:
-                    logger.error(f"❌ Не удалось распарсить user data: {user_data_str}")
-                    return None
-            
-            
-            return {
-                'id': user_data.get('id'),
-                'first_name': user_data.get('first_name'),
-                'username': user_data.get('username'),
-                'last_name': user_data.get('last_name', ''),
-                'language_code': user_data.get('language_code', 'ru')
-            }
-        else:
+        user_data_str = params.get('user')
+        if not user_data_str:
             logger.warning("❌ Поле 'user' не найдено в initData")
+            return None
+        
+        user_data = orjson.loads(user_data_str)
+        return {
+            'id': user_data.get('id'),
+            'first_name': user_data.get('first_name'),
+            'username': user_data.get('username'),
+            'last_name': user_data.get('last_name', ''),
+            'language_code': user_data.get('language_code', 'ru')
+        }
             
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"❌ Ошибка парсинга JSON в initData: {e}")
     except Exception as e:
         logger.error(f"❌ Ошибка парсинга initData: {e}")
@@ -255,49 +295,234 @@ def get_user_from_init_data(init_data):
 
 # ===== НАСТРОЙКА БАЗЫ ДАННЫХ =====
 
-def get_db_connection():
-    """Подключение только к PostgreSQL (без SQLite fallback)"""
-    if 'DATABASE_URL' not in os.environ:
-        raise Exception("❌ DATABASE_URL не найден! Добавь в Railway Variables")
+class PgConnection(psycopg2.extensions.connection):
+    """Соединение пула, которое помнит свои подготовленные запросы"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+DB_POOL_MIN_CONN = 2
+DB_POOL_MAX_CONN = 20
+
+_pg_pool = None
+_pg_pool_lock = Lock()
+
+def get_pg_pool():
+    """Пул соединений с PostgreSQL (создается при первом обращении в процессе)"""
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                if DATABASE_URL is None:
+                    raise Exception("❌ DATABASE_URL не найден! Добавь в Railway Variables")
+                
+                parsed_url = urlparse(DATABASE_URL)
+                logger.info(f"🔗 Создание пула подключений к PostgreSQL: {parsed_url.hostname}")
+                _pg_pool = ThreadedConnectionPool(
+                    DB_POOL_MIN_CONN, DB_POOL_MAX_CONN,
+                    database=parsed_url.path[1:],
+                    user=parsed_url.username,
+                    password=parsed_url.password,
+                    host=parsed_url.hostname,
+                    port=parsed_url.port,
+                    sslmode='require',
+                    connection_factory=PgConnection
+                )
+                logger.info("✅ Пул подключений к PostgreSQL создан!")
+    return _pg_pool
+
+class PooledConnection:
+    """Соединение из пула: close() и выход из with возвращают его в пул"""
+    
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    
+    def close(self):
+        if self._conn is not None:
+            self._pool.putconn(self._conn)
+            self._conn = None
     
-    database_url = os.environ['DATABASE_URL']
-    logger.info(f"🔗 Подключение к PostgreSQL: {database_url}")
+    def __enter__(self):
+        return self
     
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+class RequestConnection(PooledConnection):
+    """Соединение на время HTTP-запроса: его делят все хелперы одного запроса.
+    
+    close() ничего не делает: незавершенную транзакцию откатывает и
+    возвращает соединение в пул teardown_request.
+    """
+    
+    def close(self):
+        pass
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        # Незакоммиченные изменения упавшего хелпера не должен закоммитить следующий
+        if exc_type is not None and self._conn is not None and not self._conn.closed:
+            self._conn.rollback()
+    
+    def release(self):
+        """Откатывает незавершенную транзакцию и возвращает соединение в пул"""
+        conn = self._conn
+        try:
+            if conn is not None and not conn.closed and conn.info.transaction_status in (
+                psycopg2.extensions.TRANSACTION_STATUS_INTRANS,
+                psycopg2.extensions.TRANSACTION_STATUS_INERROR,
+            ):
+                conn.rollback()
+        finally:
+            PooledConnection.close(self)
+
+# Горячие запросы собираются один раз - драйвер получает одну и ту же строку
+_Q_INSERT_EXPENSE = '''INSERT INTO expenses (user_id, user_name, amount, category, description, space_id, currency)
+                         VALUES (%s, %s, %s, %s, %s, %s, %s)'''
+# Многострочный INSERT для execute_values: VALUES %s разворачивается в пачку строк
+_Q_INSERT_EXPENSES_VALUES = '''INSERT INTO expenses (user_id, user_name, amount, category, description, space_id, currency)
+                               VALUES %s'''
+# Вставка траты только если автор состоит в пространстве: проверка прав в том же выражении
+_Q_INSERT_EXPENSE_IF_MEMBER = '''INSERT INTO expenses (user_id, user_name, amount, category, description, space_id, currency)
+                                   SELECT %s, %s, %s, %s, %s, %s, %s
+                                   WHERE EXISTS (SELECT 1 FROM space_members WHERE user_id = %s AND space_id = %s)'''
+_Q_SELECT_ROLE = '''SELECT role FROM space_members WHERE space_id = %s AND user_id = %s'''
+_Q_DELETE_MEMBER = '''DELETE FROM space_members
+                        WHERE space_id = %s AND user_id = %s AND role <> 'owner'
+                          AND EXISTS (SELECT 1 FROM space_members sm
+                                      WHERE sm.space_id = %s AND sm.user_id = %s
+                                        AND sm.role IN ('owner', 'admin'))'''
+_Q_SPACE_BY_INVITE = '''SELECT fs.id, fs.name, fs.space_type,
+                                 EXISTS (SELECT 1 FROM space_members sm
+                                         WHERE sm.space_id = fs.id AND sm.user_id = %s)
+                          FROM financial_spaces fs
+                          WHERE fs.invite_code = %s AND fs.is_active = TRUE'''
+
+_Q_IS_MEMBER = '''SELECT 1 FROM space_members WHERE user_id = %s AND space_id = %s'''
+
+# Категории /get_analytics; общее число трат и сумма за текущий месяц (для бюджета) -
+# оконными функциями в том же проходе, что и группировка
+_ANALYTICS_CATEGORIES_SQL = '''SELECT category, SUM(amount) as total, COUNT(*) as count,
+                                      SUM(COUNT(*)) OVER () as total_count,
+                                      SUM(SUM(CASE WHEN DATE_TRUNC('month', date) = DATE_TRUNC('month', CURRENT_DATE) THEN amount ELSE 0 END)) OVER () as total_spent
+                               FROM expenses 
+                               WHERE {where}
+                               GROUP BY category 
+                               ORDER BY total DESC'''
+
+# Серверные подготовленные запросы PostgreSQL: имя -> (типовой запрос, текст для PREPARE)
+_PREPARED_QUERIES = {
+    'ins_expense': (
+        _Q_INSERT_EXPENSE,
+        '''INSERT INTO expenses (user_id, user_name, amount, category, description, space_id, currency)
+           VALUES ($1, $2, $3, $4, $5, $6, $7)'''
+    ),
+    'ins_expense_if_member': (
+        _Q_INSERT_EXPENSE_IF_MEMBER,
+        '''INSERT INTO expenses (user_id, user_name, amount, category, description, space_id, currency)
+           SELECT $1::bigint, $2::text, $3::real, $4::text, $5::text, $6::integer, $7::text
+           WHERE EXISTS (SELECT 1 FROM space_members WHERE user_id = $8 AND space_id = $9)'''
+    ),
+    'select_role': (
+        _Q_SELECT_ROLE,
+        '''SELECT role FROM space_members WHERE space_id = $1 AND user_id = $2'''
+    ),
+    'delete_member': (
+        _Q_DELETE_MEMBER,
+        '''DELETE FROM space_members
+           WHERE space_id = $1 AND user_id = $2 AND role <> 'owner'
+             AND EXISTS (SELECT 1 FROM space_members sm
+                         WHERE sm.space_id = $3 AND sm.user_id = $4
+                           AND sm.role IN ('owner', 'admin'))'''
+    ),
+    'is_member': (
+        _Q_IS_MEMBER,
+        '''SELECT 1 FROM space_members WHERE user_id = $1 AND space_id = $2'''
+    ),
+    'analytics_space': (
+        _ANALYTICS_CATEGORIES_SQL.format(where="space_id = %s"),
+        _ANALYTICS_CATEGORIES_SQL.format(where="space_id = $1")
+    ),
+    'analytics_space_user': (
+        _ANALYTICS_CATEGORIES_SQL.format(where="space_id = %s AND user_id = %s"),
+        _ANALYTICS_CATEGORIES_SQL.format(where="space_id = $1 AND user_id = $2")
+    ),
+}
+
+def execute_prepared(conn, cursor, name, params):
+    """Выполняет горячий запрос через EXECUTE.
+    
+    PREPARE делается лениво, один раз на соединение пула; план запроса
+    кешируется сервером.
+    """
+    query, prepare_sql = _PREPARED_QUERIES[name]
+    
+    prepared = getattr(conn, 'prepared', None)
+    if prepared is None:
+        cursor.execute(query, params)
+        return
+    
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {prepare_sql}")
+        prepared.add(name)
+    
+    placeholders = ', '.join(['%s'] * prepare_sql.count('$'))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
+def _checkout_connection(pool):
+    """Берет живое соединение из пула"""
+    conn = pool.getconn()
+    if conn.closed:
+        # Сервер разорвал соединение - выбрасываем его и берем новое
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def get_db_connection():
+    """Соединение с PostgreSQL из пула (без SQLite fallback).
+    
+    Внутри HTTP-запроса возвращает одно соединение на весь запрос.
+    """
     try:
-        parsed_url = urlparse(database_url)
-        conn = psycopg2.connect(
-            database=parsed_url.path[1:],
-            user=parsed_url.username,
-            password=parsed_url.password,
-            host=parsed_url.hostname,
-            port=parsed_url.port,
-            sslmode='require'
-        )
-        logger.info("✅ Успешное подключение к PostgreSQL!")
-        return conn
+        pool = get_pg_pool()
+        if has_request_context():
+            conn = g.get('db_conn')
+            if conn is None or conn.closed:
+                if conn is not None:
+                    conn.release()
+                conn = g.db_conn = RequestConnection(pool, _checkout_connection(pool))
+            elif conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                # Ошибка в предыдущем хелпере оборвала транзакцию - следующему нужна новая
+                conn.rollback()
+            return conn
+        return PooledConnection(pool, _checkout_connection(pool))
     except Exception as e:
         logger.error(f"❌ Ошибка подключения к PostgreSQL: {e}")
         raise
+
+@flask_app.teardown_request
+def release_request_connection(exc):
+    """Откатывает незавершенную транзакцию запроса и возвращает соединение в пул"""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.release()
     
 def check_database_connection():
     """Проверка подключения к базе данных"""
     logger.info("🔍 Проверка подключения к БД...")
     
-    if 'DATABASE_URL' not in os.environ:
+    if DATABASE_URL is None:
         logger.error("❌ DATABASE_URL не найден в переменных окружения!")
         return False
     
-    db_url = os.environ['DATABASE_URL']
-    logger.info(f"📊 DATABASE_URL: {db_url}")
+    logger.info(f"📊 DATABASE_URL: {DATABASE_URL}")
     
     try:
-        conn = get_db_connection()
-        
-        if isinstance(conn, sqlite3.Connection):
-            logger.error("❌❌❌ ИСПОЛЬЗУЕТСЯ SQLITE! PostgreSQL недоступен!")
-            logger.error("❌❌❌ Проверь DATABASE_URL в настройках Railway!")
-            return False
-        else:
+        with get_db_connection() as conn:
             logger.info("✅ Успешное подключение к PostgreSQL!")
             
             # Проверяем доступность таблиц
@@ -306,9 +531,8 @@ def check_database_connection():
             result = cursor.fetchone()
             logger.info(f"🕒 Время БД: {result[0]}")
             logger.info(f"📋 Версия PostgreSQL: {result[1].split(',')[0]}")
-            
-            conn.close()
-            return True
+        
+        return True
             
     except Exception as e:
         logger.error(f"❌ Ошибка подключения к PostgreSQL: {e}")
@@ -316,6 +540,42 @@ def check_database_connection():
 
 
 
+# Порядок ролей для сортировки участников: owner, admin, остальные
+ROLE_RANK_SQL = "CASE role WHEN 'owner' THEN 0 WHEN 'admin' THEN 1 ELSE 2 END"
+
+# Идемпотентные миграции схемы для уже существующих баз
+SCHEMA_MIGRATIONS = [
+    f'''ALTER TABLE space_members ADD COLUMN IF NOT EXISTS role_rank SMALLINT
+       GENERATED ALWAYS AS ({ROLE_RANK_SQL}) STORED''',
+    '''CREATE INDEX IF NOT EXISTS space_members_ordered_idx
+       ON space_members (space_id, role_rank, joined_at)''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS space_members_space_user_idx
+       ON space_members (space_id, user_id) INCLUDE (role, joined_at)''',
+    '''CREATE INDEX IF NOT EXISTS expenses_space_date_idx
+       ON expenses (space_id, date DESC)''',
+    '''CREATE INDEX IF NOT EXISTS expenses_user_space_date_idx
+       ON expenses (user_id, space_id, date DESC) INCLUDE (amount)''',
+    '''CREATE INDEX IF NOT EXISTS expenses_user_date_idx
+       ON expenses (user_id, date) INCLUDE (amount)''',
+    '''CREATE INDEX IF NOT EXISTS space_members_user_space_idx
+       ON space_members (user_id, space_id) INCLUDE (role)''',
+]
+
+def apply_schema_migrations(conn, c):
+    """Применяет SCHEMA_MIGRATIONS; ошибка одной миграции не мешает остальным"""
+    for sql in SCHEMA_MIGRATIONS:
+        try:
+            c.execute("SAVEPOINT migration")
+            c.execute(sql)
+            c.execute("RELEASE SAVEPOINT migration")
+        except Exception as e:
+            c.execute("ROLLBACK TO SAVEPOINT migration")
+            logger.warning(f"⚠️ Миграция пропущена: {e}")
+    # Обновляем статистику планировщика, чтобы новые индексы сразу использовались
+    c.execute("ANALYZE")
+    conn.commit()
+    logger.info("✅ Миграции схемы применены")
+
 def init_db():
     """Инициализация базы данных"""
     logger.info("🔍 Инициализация базы данных...")
@@ -323,180 +583,108 @@ def init_db():
     conn = get_db_connection()
     
     try:
-        # СНАЧАЛА проверяем тип подключения
-        if isinstance(conn, sqlite3.Connection):
-            logger.info("📁 Используется SQLite")
-            db_type = "sqlite"
-        else:
-            logger.info("🐘 Используется PostgreSQL")
-            db_type = "postgresql"
+        logger.info("🐘 Используется PostgreSQL")
         
         c = conn.cursor()
         
-        if db_type == "sqlite":
-            # SQLite
-            c.execute('''CREATE TABLE IF NOT EXISTS financial_spaces
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          name TEXT NOT NULL,
-                          description TEXT,
-                          space_type TEXT DEFAULT 'personal',
-                          created_by INTEGER,
-                          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                          invite_code TEXT UNIQUE,
-                          is_active BOOLEAN DEFAULT TRUE)''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS space_members
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          space_id INTEGER,
-                          user_id INTEGER,
-                          user_name TEXT,
-                          role TEXT DEFAULT 'member',
-                          joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                          FOREIGN KEY (space_id) REFERENCES financial_spaces (id))''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS expenses
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          user_id INTEGER, 
-                          user_name TEXT,
-                          space_id INTEGER,
-                          amount REAL, 
-                          category TEXT, 
-                          description TEXT, 
-                          date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                          currency TEXT DEFAULT 'RUB',
-                          FOREIGN KEY (space_id) REFERENCES financial_spaces (id))''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS budgets
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          user_id INTEGER,
-                          space_id INTEGER,
-                          amount REAL,
-                          month_year TEXT,
-                          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                          currency TEXT DEFAULT 'RUB',
-                          FOREIGN KEY (space_id) REFERENCES financial_spaces (id))''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS budget_alerts
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          user_id INTEGER,
-                          space_id INTEGER,
-                          budget_amount REAL,
-                          spent_amount REAL,
-                          percentage REAL,
-                          alert_type TEXT,
-                          sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                          FOREIGN KEY (space_id) REFERENCES financial_spaces (id))''')
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS user_categories
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          user_id INTEGER,
-                          space_id INTEGER,
-                          category_name TEXT,
-                          category_icon TEXT,
-                          is_custom BOOLEAN DEFAULT TRUE,
-                          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                          FOREIGN KEY (space_id) REFERENCES financial_spaces (id))''')
+        logger.info("🗃️ Создание таблиц в PostgreSQL...")
             
-        else:
-            # PostgreSQL - ИСПРАВЛЕННЫЙ код
-            logger.info("🗃️ Создание таблиц в PostgreSQL...")
-            
-            # СОЗДАЕМ ТАБЛИЦЫ ПО ОДНОЙ в правильном порядке
-            tables_sql = [
-                # 1. financial_spaces - ДОЛЖНА БЫТЬ ПЕРВОЙ (главная таблица)
-                '''CREATE TABLE IF NOT EXISTS financial_spaces (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    description TEXT,
-                    space_type TEXT DEFAULT 'personal',
-                    created_by BIGINT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    invite_code TEXT UNIQUE,
-                    is_active BOOLEAN DEFAULT TRUE
-                )''',
+        # СОЗДАЕМ ТАБЛИЦЫ ПО ОДНОЙ в правильном порядке
+        tables_sql = [
+            # 1. financial_spaces - ДОЛЖНА БЫТЬ ПЕРВОЙ (главная таблица)
+            '''CREATE TABLE IF NOT EXISTS financial_spaces (
+                id SERIAL PRIMARY KEY,
+                name TEXT NOT NULL,
+                description TEXT,
+                space_type TEXT DEFAULT 'personal',
+                created_by BIGINT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                invite_code TEXT UNIQUE,
+                is_active BOOLEAN DEFAULT TRUE
+            )''',
                 
-                # 2. space_members - зависит от financial_spaces
-                '''CREATE TABLE IF NOT EXISTS space_members (
-                    id SERIAL PRIMARY KEY,
-                    space_id INTEGER REFERENCES financial_spaces(id),
-                    user_id BIGINT,
-                    user_name TEXT,
-                    role TEXT DEFAULT 'member',
-                    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )''',
+            # 2. space_members - зависит от financial_spaces
+            '''CREATE TABLE IF NOT EXISTS space_members (
+                id SERIAL PRIMARY KEY,
+                space_id INTEGER REFERENCES financial_spaces(id),
+                user_id BIGINT,
+                user_name TEXT,
+                role TEXT DEFAULT 'member',
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                role_rank SMALLINT GENERATED ALWAYS AS (CASE role WHEN 'owner' THEN 0 WHEN 'admin' THEN 1 ELSE 2 END) STORED
+            )''',
                 
-                # 3. expenses - зависит от financial_spaces
-                '''CREATE TABLE IF NOT EXISTS expenses (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    user_name TEXT,
-                    space_id INTEGER REFERENCES financial_spaces(id),
-                    amount REAL,
-                    category TEXT,
-                    description TEXT,
-                    date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    currency TEXT DEFAULT 'RUB'
-                )''',
+            # 3. expenses - зависит от financial_spaces
+            '''CREATE TABLE IF NOT EXISTS expenses (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT,
+                user_name TEXT,
+                space_id INTEGER REFERENCES financial_spaces(id),
+                amount REAL,
+                category TEXT,
+                description TEXT,
+                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                currency TEXT DEFAULT 'RUB'
+            )''',
                 
-                # 4. budgets - зависит от financial_spaces
-                '''CREATE TABLE IF NOT EXISTS budgets (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    space_id INTEGER REFERENCES financial_spaces(id),
-                    amount REAL,
-                    month_year TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    currency TEXT DEFAULT 'RUB'
-                )''',
+            # 4. budgets - зависит от financial_spaces
+            '''CREATE TABLE IF NOT EXISTS budgets (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT,
+                space_id INTEGER REFERENCES financial_spaces(id),
+                amount REAL,
+                month_year TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                currency TEXT DEFAULT 'RUB'
+            )''',
                 
-                # 5. budget_alerts - зависит от financial_spaces
-                '''CREATE TABLE IF NOT EXISTS budget_alerts (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    space_id INTEGER REFERENCES financial_spaces(id),
-                    budget_amount REAL,
-                    spent_amount REAL,
-                    percentage REAL,
-                    alert_type TEXT,
-                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )''',
+            # 5. budget_alerts - зависит от financial_spaces
+            '''CREATE TABLE IF NOT EXISTS budget_alerts (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT,
+                space_id INTEGER REFERENCES financial_spaces(id),
+                budget_amount REAL,
+                spent_amount REAL,
+                percentage REAL,
+                alert_type TEXT,
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''',
                 
-                # 6. user_categories - зависит от financial_spaces
-                '''CREATE TABLE IF NOT EXISTS user_categories (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    space_id INTEGER REFERENCES financial_spaces(id),
-                    category_name TEXT,
-                    category_icon TEXT,
-                    is_custom BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )'''
-            ]
+            # 6. user_categories - зависит от financial_spaces
+            '''CREATE TABLE IF NOT EXISTS user_categories (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT,
+                space_id INTEGER REFERENCES financial_spaces(id),
+                category_name TEXT,
+                category_icon TEXT,
+                is_custom BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )'''
+        ]
             
-            # ВЫПОЛНЯЕМ КАЖДЫЙ CREATE TABLE отдельно с обработкой ошибок
-            table_names = [
-                "financial_spaces", "space_members", "expenses", 
-                "budgets", "budget_alerts", "user_categories"
-            ]
+        # ВЫПОЛНЯЕМ КАЖДЫЙ CREATE TABLE отдельно с обработкой ошибок
+        table_names = [
+            "financial_spaces", "space_members", "expenses", 
+            "budgets", "budget_alerts", "user_categories"
+        ]
             
-            for i, (sql, table_name) in enumerate(zip(tables_sql, table_names)):
-                try:
-                    c.execute(sql)
-                    logger.info(f"✅ Таблица {i+1}/6: {table_name}")
-                except Exception as e:
-                    logger.error(f"❌ Ошибка создания таблицы {table_name}: {e}")
-                    # Продолжаем создавать остальные таблицы
-                    continue
+        for i, (sql, table_name) in enumerate(zip(tables_sql, table_names)):
+            try:
+                c.execute(sql)
+                logger.info(f"✅ Таблица {i+1}/6: {table_name}")
+            except Exception as e:
+                logger.error(f"❌ Ошибка создания таблицы {table_name}: {e}")
+                # Продолжаем создавать остальные таблицы
+                continue
             
-            conn.commit()
-            logger.info("✅ Все таблицы созданы/проверены")
+        conn.commit()
+        logger.info("✅ Все таблицы созданы/проверены")
+        
+        apply_schema_migrations(conn, c)
         
         # ПРОВЕРЯЕМ СОЗДАНИЕ ТАБЛИЦ
         logger.info("🔍 Проверка существования таблиц...")
-        if db_type == "sqlite":
-            c.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        else:
-            c.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
+        c.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
         
         tables = c.fetchall()
         logger.info(f"📊 Найдено таблиц в базе: {len(tables)}")
@@ -518,32 +706,26 @@ def init_db():
             ('Другое', '❓')
         ]
         
-        # ДЛЯ POSTGRESQL: сначала создаем системное пространство если нужно
-        if db_type == "postgresql":
-            try:
-                # Пытаемся создать системное пространство для категорий
-                c.execute('''
-                    INSERT INTO financial_spaces (id, name, description, space_type, created_by, invite_code, is_active)
-                    VALUES (0, 'Системное пространство', 'Для стандартных категорий', 'system', 0, 'SYSTEM_0', TRUE)
-                    ON CONFLICT (id) DO NOTHING
-                ''')
-                logger.info("✅ Системное пространство для категорий создано/проверено")
-            except Exception as e:
-                logger.warning(f"⚠️ Системное пространство: {e}")
+        # Сначала создаем системное пространство для стандартных категорий
+        try:
+            # Пытаемся создать системное пространство для категорий
+            c.execute('''
+                INSERT INTO financial_spaces (id, name, description, space_type, created_by, invite_code, is_active)
+                VALUES (0, 'Системное пространство', 'Для стандартных категорий', 'system', 0, 'SYSTEM_0', TRUE)
+                ON CONFLICT (id) DO NOTHING
+            ''')
+            logger.info("✅ Системное пространство для категорий создано/проверено")
+        except Exception as e:
+            logger.warning(f"⚠️ Системное пространство: {e}")
         
         # ДОБАВЛЯЕМ КАТЕГОРИИ
         categories_added = 0
         for category_name, icon in default_categories:
             try:
-                if db_type == "sqlite":
-                    c.execute('''INSERT OR IGNORE INTO user_categories 
-                                 (user_id, space_id, category_name, category_icon, is_custom) 
-                                 VALUES (0, 0, ?, ?, FALSE)''', (category_name, icon))
-                else:
-                    c.execute('''INSERT INTO user_categories 
-                                 (user_id, space_id, category_name, category_icon, is_custom) 
-                                 VALUES (0, 0, %s, %s, FALSE)
-                                 ON CONFLICT DO NOTHING''', (category_name, icon))
+                c.execute('''INSERT INTO user_categories 
+                             (user_id, space_id, category_name, category_icon, is_custom) 
+                             VALUES (0, 0, %s, %s, FALSE)
+                             ON CONFLICT DO NOTHING''', (category_name, icon))
                 categories_added += 1
             except Exception as e:
                 logger.warning(f"⚠️ Не удалось добавить категорию '{category_name}': {e}")
@@ -568,45 +750,26 @@ def init_db():
 async def check_budget_alerts():
     """Проверка и отправка уведомлений о бюджете"""
     try:
-        conn = get_db_connection()
-        
         # Получаем текущий месяц
         current_month = datetime.now().strftime('%Y-%m')
         
         # Находим пользователей с превышением бюджета
-        if isinstance(conn, sqlite3.Connection):
-            query = '''
-                SELECT b.user_id, b.space_id, b.amount as budget, 
-                       COALESCE(SUM(e.amount), 0) as spent,
-                       fs.name as space_name,
-                       sm.user_name
-                FROM budgets b
-                JOIN financial_spaces fs ON b.space_id = fs.id
-                JOIN space_members sm ON b.user_id = sm.user_id AND b.space_id = sm.space_id
-                LEFT JOIN expenses e ON b.user_id = e.user_id AND b.space_id = e.space_id 
-                                    AND strftime('%Y-%m', e.date) = ?
-                WHERE b.month_year = ? AND fs.is_active = TRUE
-                GROUP BY b.user_id, b.space_id, b.amount, fs.name, sm.user_name
-            '''
-            df = pd.read_sql_query(query, conn, params=(current_month, current_month))
-        else:
-            query = '''
-                SELECT b.user_id, b.space_id, b.amount as budget, 
-                       COALESCE(SUM(e.amount), 0) as spent,
-                       fs.name as space_name,
-                       sm.user_name
-                FROM budgets b
-                JOIN financial_spaces fs ON b.space_id = fs.id
-                JOIN space_members sm ON b.user_id = sm.user_id AND b.space_id = sm.space_id
-                LEFT JOIN expenses e ON b.user_id = e.user_id AND b.space_id = e.space_id 
-                                    AND DATE_TRUNC('month', e.date) = DATE_TRUNC('month', CURRENT_DATE)
-                WHERE b.month_year = %s AND fs.is_active = TRUE
-                GROUP BY b.user_id, b.space_id, b.amount, fs.name, sm.user_name
-            '''
+        query = '''
+            SELECT b.user_id, b.space_id, b.amount as budget, 
+                   COALESCE(SUM(e.amount), 0) as spent,
+                   fs.name as space_name,
+                   sm.user_name
+            FROM budgets b
+            JOIN financial_spaces fs ON b.space_id = fs.id
+            JOIN space_members sm ON b.user_id = sm.user_id AND b.space_id = sm.space_id
+            LEFT JOIN expenses e ON b.user_id = e.user_id AND b.space_id = e.space_id 
+                                AND DATE_TRUNC('month', e.date) = DATE_TRUNC('month', CURRENT_DATE)
+            WHERE b.month_year = %s AND fs.is_active = TRUE
+            GROUP BY b.user_id, b.space_id, b.amount, fs.name, sm.user_name
+        '''
+        with get_db_connection() as conn:
             df = pd.read_sql_query(query, conn, params=(current_month,))
         
-        conn.close()
-        
         # Создаем приложение для отправки сообщений
         application = Application.builder().token(BOT_TOKEN).build()
         
@@ -644,16 +807,10 @@ def was_alert_sent_today(user_id, space_id, threshold):
     conn = get_db_connection()
     try:
         today = datetime.now().strftime('%Y-%m-%d')
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT 1 FROM budget_alerts 
-                      WHERE user_id = ? AND space_id = ? AND alert_type = ? 
-                      AND DATE(sent_at) = ?'''
-            df = pd.read_sql_query(query, conn, params=(user_id, space_id, f"{int(threshold*100)}%", today))
-        else:
-            query = '''SELECT 1 FROM budget_alerts 
-                      WHERE user_id = %s AND space_id = %s AND alert_type = %s 
-                      AND DATE(sent_at) = %s'''
-            df = pd.read_sql_query(query, conn, params=(user_id, space_id, f"{int(threshold*100)}%", today))
+        query = '''SELECT 1 FROM budget_alerts 
+                  WHERE user_id = %s AND space_id = %s AND alert_type = %s 
+                  AND DATE(sent_at) = %s'''
+        df = pd.read_sql_query(query, conn, params=(user_id, space_id, f"{int(threshold*100)}%", today))
         
         return not df.empty
     except Exception as e:
@@ -666,16 +823,10 @@ def log_budget_alert(user_id, space_id, budget_amount, spent_amount, percentage,
     """Логируем отправленное уведомление"""
     conn = get_db_connection()
     try:
-        if isinstance(conn, sqlite3.Connection):
-            conn.execute('''INSERT INTO budget_alerts 
-                          (user_id, space_id, budget_amount, spent_amount, percentage, alert_type)
-                          VALUES (?, ?, ?, ?, ?, ?)''',
-                        (user_id, space_id, budget_amount, spent_amount, percentage, alert_type))
-        else:
-            conn.cursor().execute('''INSERT INTO budget_alerts 
-                                   (user_id, space_id, budget_amount, spent_amount, percentage, alert_type)
-                                   VALUES (%s, %s, %s, %s, %s, %s)''',
-                                 (user_id, space_id, budget_amount, spent_amount, percentage, alert_type))
+        conn.cursor().execute('''INSERT INTO budget_alerts 
+                               (user_id, space_id, budget_amount, spent_amount, percentage, alert_type)
+                               VALUES (%s, %s, %s, %s, %s, %s)''',
+                             (user_id, space_id, budget_amount, spent_amount, percentage, alert_type))
         conn.commit()
     except Exception as e:
         logger.error(f"❌ Ошибка логирования уведомления: {e}")
@@ -715,23 +866,16 @@ def generate_budget_alert(percentage, budget, spent, space_name, threshold):
 async def send_daily_reports():
     """Отправка ежедневных отчетов"""
     try:
-        conn = get_db_connection()
-        
         # Получаем всех активных пользователей
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT DISTINCT user_id, user_name FROM space_members'''
-            df = pd.read_sql_query(query, conn)
-        else:
-            query = '''SELECT DISTINCT user_id, user_name FROM space_members'''
-            df = pd.read_sql_query(query, conn)
-        
-        conn.close()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('''SELECT DISTINCT user_id, user_name FROM space_members''')
+            members = c.fetchall()
         
         application = Application.builder().token(BOT_TOKEN).build()
         
-        for _, row in df.iterrows():
-            user_id = int(row['user_id'])
-            user_name = row['user_name']
+        for user_id, user_name in members:
+            user_id = int(user_id)
             
             try:
                 report = generate_daily_report(user_id)
@@ -747,6 +891,13 @@ async def send_daily_reports():
     except Exception as e:
         logger.error(f"❌ Ошибка в send_daily_reports: {e}")
 
+_Q_DAILY_REPORT = '''SELECT
+    (SELECT COALESCE(SUM(amount), 0) FROM expenses
+     WHERE user_id = %s AND DATE(date) = %s),
+    (SELECT COALESCE(SUM(amount), 0) FROM expenses
+     WHERE user_id = %s AND date >= CURRENT_DATE - INTERVAL '7 days'),
+    (SELECT COUNT(DISTINCT space_id) FROM space_members WHERE user_id = %s)'''
+
 def generate_daily_report(user_id):
     """Генерация ежедневного отчета"""
     conn = get_db_connection()
@@ -754,42 +905,10 @@ def generate_daily_report(user_id):
     try:
         today = datetime.now().strftime('%Y-%m-%d')
         
-        if isinstance(conn, sqlite3.Connection):
-            # Расходы за сегодня
-            today_query = '''SELECT COALESCE(SUM(amount), 0) as today_spent 
-                           FROM expenses 
-                           WHERE user_id = ? AND DATE(date) = ?'''
-            today_df = pd.read_sql_query(today_query, conn, params=(user_id, today))
-            
-            # Расходы за неделю
-            week_query = '''SELECT COALESCE(SUM(amount), 0) as week_spent 
-                          FROM expenses 
-                          WHERE user_id = ? AND date >= DATE('now', '-7 days')'''
-            week_df = pd.read_sql_query(week_query, conn, params=(user_id,))
-            
-            # Активные пространства
-            spaces_query = '''SELECT COUNT(DISTINCT space_id) as active_spaces 
-                            FROM space_members WHERE user_id = ?'''
-            spaces_df = pd.read_sql_query(spaces_query, conn, params=(user_id,))
-            
-        else:
-            today_query = '''SELECT COALESCE(SUM(amount), 0) as today_spent 
-                           FROM expenses 
-                           WHERE user_id = %s AND DATE(date) = %s'''
-            today_df = pd.read_sql_query(today_query, conn, params=(user_id, today))
-            
-            week_query = '''SELECT COALESCE(SUM(amount), 0) as week_spent 
-                          FROM expenses 
-                          WHERE user_id = %s AND date >= CURRENT_DATE - INTERVAL '7 days'''
-            week_df = pd.read_sql_query(week_query, conn, params=(user_id,))
-            
-            spaces_query = '''SELECT COUNT(DISTINCT space_id) as active_spaces 
-                            FROM space_members WHERE user_id = %s'''
-            spaces_df = pd.read_sql_query(spaces_query, conn, params=(user_id,))
-        
-        today_spent = today_df.iloc[0]['today_spent'] if not today_df.empty else 0
-        week_spent = week_df.iloc[0]['week_spent'] if not week_df.empty else 0
-        active_spaces = spaces_df.iloc[0]['active_spaces'] if not spaces_df.empty else 0
+        # Расходы за сегодня, за неделю и активные пространства - одной строкой
+        c = conn.cursor()
+        c.execute(_Q_DAILY_REPORT, (user_id, today, user_id, user_id))
+        today_spent, week_spent, active_spaces = c.fetchone()
         
         report = (
             f"📊 <b>Ежедневный финансовый отчет</b>\n\n"
@@ -839,17 +958,16 @@ def check_tables_exist():
             'budgets', 'budget_alerts', 'user_categories'
         ]
         
+        # Одним параметризованным запросом получаем все существующие таблицы
+        cursor.execute("""
+            SELECT table_name FROM information_schema.tables 
+            WHERE table_schema = 'public' 
+            AND table_name = ANY(%s)
+        """, (tables,))
+        existing_tables = {row[0] for row in cursor.fetchall()}
+        
         for table in tables:
-            cursor.execute(f"""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_schema = 'public' 
-                    AND table_name = '{table}'
-                )
-            """)
-            exists = cursor.fetchone()[0]
-            
-            if exists:
+            if table in existing_tables:
                 logger.info(f"✅ Таблица {table} существует")
             else:
                 logger.error(f"❌ Таблица {table} НЕ существует!")
@@ -887,7 +1005,8 @@ def create_missing_table(table_name, cursor):
                 user_id BIGINT,
                 user_name TEXT,
                 role TEXT DEFAULT 'member',
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                role_rank SMALLINT GENERATED ALWAYS AS (CASE role WHEN 'owner' THEN 0 WHEN 'admin' THEN 1 ELSE 2 END) STORED
             )
         ''')
     elif table_name == 'expenses':
@@ -959,9 +1078,16 @@ def check_tesseract_installation():
         logger.warning("❌ Tesseract не установлен или не добавлен в PATH")
         return False
 
-# Проверяем перед запуском
-logger.info("🔄 Проверяю Tesseract OCR...")
-TESSERACT_AVAILABLE = check_tesseract_installation()
+# Tesseract на одном изображении быстрее в однопоточном режиме: OpenMP-потоки
+# только добавляют накладные расходы (tesseract-ocr/tesseract#263).
+# pytesseract запускает tesseract дочерним процессом, он наследует окружение
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+# Проверяем перед запуском (если распознавание чеков не выключено)
+TESSERACT_AVAILABLE = False
+if ENABLE_PHOTO_OCR:
+    logger.info("🔄 Проверяю Tesseract OCR...")
+    TESSERACT_AVAILABLE = check_tesseract_installation()
 
 if TESSERACT_AVAILABLE:
     try:
@@ -983,25 +1109,36 @@ if TESSERACT_AVAILABLE:
     except Exception as e:
         TESSERACT_AVAILABLE = False
         logger.warning(f"❌ Tesseract OCR недоступен: {e}")
-else:
+elif ENABLE_PHOTO_OCR:
     logger.warning("⚠️ Tesseract не установлен. Распознавание чеков недоступно.")
+else:
+    logger.info("ℹ️ Распознавание чеков выключено (ENABLE_PHOTO_OCR)")
+
+# Длинная сторона чека после предобработки: крупнее - только дольше для Tesseract,
+# мельче - теряется текст
+OCR_MAX_SIDE = 1600
+OCR_LANG = os.environ.get('OCR_LANG', 'rus')
 
 def preprocess_image_for_ocr(image):
     """Улучшение качества изображения для OCR"""
+    from PIL import Image, ImageOps, ImageFilter
+    
     try:
         # Конвертируем в grayscale
         if image.mode != 'L':
             image = image.convert('L')
         
-        # Увеличиваем разрешение
+        # Приводим разрешение к OCR_MAX_SIDE: маленькие увеличиваем, большие уменьшаем
         width, height = image.size
         if width < 1000 or height < 1000:
-            new_size = (width * 2, height * 2)
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
+            scale = min(2, OCR_MAX_SIDE / max(width, height))
+            if scale > 1:
+                image = image.resize((int(width * scale), int(height * scale)), Image.Resampling.LANCZOS)
+        else:
+            image.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.Resampling.LANCZOS)
         
-        # Увеличиваем контрастность
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(2.0)
+        # Растягиваем контраст по гистограмме
+        image = ImageOps.autocontrast(image)
         
         # Увеличиваем резкость
         image = image.filter(ImageFilter.SHARPEN)
@@ -1014,6 +1151,24 @@ def preprocess_image_for_ocr(image):
         logger.error(f"❌ Ошибка обработки изображения: {e}")
         return image
 
+# Ключевые слова магазинов одним регулярным выражением: один проход по строке
+# вместо отдельного поиска подстроки для каждого слова
+_STORE_KEYWORDS_RE = re.compile('|'.join(map(re.escape, [
+    'магазин', 'супермаркет', 'торговый', 'центр', 'аптека', 'кафе', 'ресторан'
+])))
+
+# Паттерны для поиска сумм (улучшенные), компилируются один раз при импорте
+_TOTAL_PATTERNS_RE = [re.compile(p, re.IGNORECASE) for p in (
+    r'(?:итого|всего|сумма|к\s*оплате|total|итог|чек)[^\d]*(\d+[.,]\d{2})',
+    r'(\d+[.,]\d{2})\s*(?:руб|р|₽|rur|rub|r|рублей)',
+    r'(?:цена|стоимость|оплат|внесен)[^\d]*(\d+[.,]\d{2})',
+    r'(\d+[.,]\d{2})\s*$',  # Числа в конце строки
+)]
+_RECEIPT_NOISE_RE = re.compile(r'[^\w\s\d.,]')
+# Строка итога для прохода снизу вверх: без "сумма"/"чек", которые
+# встречаются и в строках НДС, и в номере чека
+_TOTAL_LINE_RE = re.compile(r'(?:итог|total|всего|к\s*оплате)[^\d]*(\d+[.,]\d{2})', re.IGNORECASE)
+
 def parse_receipt_text(text):
     """Улучшенный парсинг распознанного текста чека"""
     logger.info("🔍 Анализирую текст чека...")
@@ -1027,41 +1182,42 @@ def parse_receipt_text(text):
         'raw_text': text
     }
     
-    # Паттерны для поиска сумм (улучшенные)
-    total_patterns = [
-        r'(?:итого|всего|сумма|к\s*оплате|total|итог|чек)[^\d]*(\d+[.,]\d{2})',
-        r'(\d+[.,]\d{2})\s*(?:руб|р|₽|rur|rub|r|рублей)',
-        r'(?:цена|стоимость|оплат|внесен)[^\d]*(\d+[.,]\d{2})',
-        r'(\d+[.,]\d{2})\s*$',  # Числа в конце строки
-    ]
+    clean_lines = [_RECEIPT_NOISE_RE.sub('', line.lower()) for line in lines]
     
-    # Поиск магазина
-    store_keywords = ['магазин', 'супермаркет', 'торговый', 'центр', 'аптека', 'кафе', 'ресторан']
+    # Итог обычно внизу чека: ищем строку "итого"/"к оплате" снизу вверх
+    # и при находке не перебираем суммы по остальным строкам
+    for line_clean in reversed(clean_lines):
+        matches = _TOTAL_LINE_RE.findall(line_clean)
+        if matches:
+            amount = float(matches[-1].replace(',', '.'))
+            if 10 <= amount <= 50000:
+                receipt_data['total'] = amount
+                logger.info(f"💰 Найден итог: {amount}")
+                break
+    total_found = receipt_data['total'] > 0
     
     # Поиск по паттернам
-    for line in lines:
-        line_clean = re.sub(r'[^\w\s\d.,]', '', line.lower())
-        
-        # Поиск суммы
-        for pattern in total_patterns:
-            matches = re.findall(pattern, line_clean, re.IGNORECASE)
-            if matches:
-                try:
-                    amount_str = matches[-1].replace(',', '.')
-                    amount_str = re.sub(r'[^\d.]', '', amount_str)
-                    amount = float(amount_str)
+    for line, line_clean in zip(lines, clean_lines):
+        if total_found and receipt_data['store']:
+            break
+        
+        # Поиск суммы, если итог не нашелся
+        if not total_found:
+            for pattern in _TOTAL_PATTERNS_RE:
+                matches = pattern.findall(line_clean)
+                if matches:
+                    # Группа всегда вида "123.45"/"123,45" - float() не упадет
+                    amount = float(matches[-1].replace(',', '.'))
                     # Более строгая проверка на реалистичную сумму
                     if 10 <= amount <= 50000 and amount > receipt_data['total']:
                         receipt_data['total'] = amount
                         logger.info(f"💰 Найдена сумма: {amount}")
                         break
-                except ValueError:
-                    continue
         
         # Поиск магазина
         if not receipt_data['store']:
             # Ищем строки с названиями магазинов
-            if any(keyword in line_clean for keyword in store_keywords):
+            if _STORE_KEYWORDS_RE.search(line_clean):
                 # Берем первую строку с ключевым словом как название магазина
                 receipt_data['store'] = line.strip()[:50]  # Ограничиваем длину
                 logger.info(f"🏪 Найден магазин: {receipt_data['store']}")
@@ -1073,7 +1229,39 @@ def parse_receipt_text(text):
     
     return receipt_data
 
+# Пул для OCR, чтобы не блокировать event loop бота.
+# Потоков достаточно: tesseract работает отдельным процессом
+MEDIA_WORKERS = os.cpu_count() or 2
+_MEDIA_EXECUTOR = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix='media')
+
 async def process_receipt_photo(image_bytes):
+    """Распознает чек в пуле _MEDIA_EXECUTOR"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_MEDIA_EXECUTOR, process_receipt_photo_sync, image_bytes)
+
+# Настройки OCR в порядке перебора
+_OCR_CONFIGS = (
+    r'--oem 3 --psm 6',
+    r'--oem 3 --psm 4',
+    r'--oem 3 --psm 8',
+    r'--oem 3 --psm 6 -c tessedit_char_whitelist=0123456789.,рубРУБкКтТ₽',
+)
+
+# Слова с уверенностью Tesseract ниже порога считаются мусором
+OCR_MIN_CONF = 60
+
+def ocr_image_text(image, config):
+    """Текст изображения без слов с низкой уверенностью, построчно"""
+    data = pytesseract.image_to_data(image, lang=OCR_LANG, config=config,
+                                     output_type=pytesseract.Output.DICT)
+    lines = {}
+    for word, conf, block, par, line in zip(data['text'], data['conf'], data['block_num'],
+                                            data['par_num'], data['line_num']):
+        if word.strip() and float(conf) >= OCR_MIN_CONF:
+            lines.setdefault((block, par, line), []).append(word)
+    return '\n'.join(' '.join(words) for words in lines.values())
+
+def process_receipt_photo_sync(image_bytes):
     """Обрабатываем фото чека через Tesseract с улучшенной обработкой"""
     if not TESSERACT_AVAILABLE:
         logger.warning("❌ Tesseract недоступен для распознавания чеков")
@@ -1082,28 +1270,30 @@ async def process_receipt_photo(image_bytes):
     try:
         logger.info("🔍 Распознаю чек через Tesseract...")
         
+        from PIL import Image
         image = Image.open(io.BytesIO(image_bytes))
         
         # Улучшаем качество изображения
         image = preprocess_image_for_ocr(image)
         
-        # Пробуем разные настройки OCR
-        configs = [
-            r'--oem 3 --psm 6',
-            r'--oem 3 --psm 4', 
-            r'--oem 3 --psm 8',
-            r'--oem 3 --psm 6 -c tessedit_char_whitelist=0123456789.,рубРУБкКтТ₽'
-        ]
-        
+        # PSM 6 (единый блок текста) подходит чекам; остальные настройки -
+        # только если сумма не нашлась
         best_text = ""
-        for config in configs:
+        for config in _OCR_CONFIGS:
             try:
-                text = pytesseract.image_to_string(image, lang='rus+eng', config=config)
-                if len(text.strip()) > len(best_text.strip()):
-                    best_text = text
+                text = ocr_image_text(image, config)
             except Exception as e:
                 logger.warning(f"❌ Ошибка OCR с конфигом {config}: {e}")
                 continue
+            if not text.strip():
+                continue
+            receipt_data = parse_receipt_text(text)
+            if receipt_data['total'] > 0:
+                logger.info(f"✅ Распознано символов: {len(text)}")
+                logger.info(f"📄 Текст чека: {text[:300]}...")
+                return receipt_data
+            if len(text.strip()) > len(best_text.strip()):
+                best_text = text
         
         if not best_text.strip():
             logger.warning("❌ Не удалось распознать текст")
@@ -1120,110 +1310,96 @@ async def process_receipt_photo(image_bytes):
 
 # ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
 def is_user_in_space(user_id, space_id):
-    """Проверяет, состоит ли пользователь в пространстве"""
-    conn = get_db_connection()
+    """Проверяет, состоит ли пользователь в пространстве.
     
-    try:
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT 1 FROM space_members WHERE user_id = ? AND space_id = ?'''
-            df = pd.read_sql_query(query, conn, params=(user_id, space_id))
-        else:
-            query = '''SELECT 1 FROM space_members WHERE user_id = %s AND space_id = %s'''
-            df = pd.read_sql_query(query, conn, params=(user_id, space_id))
-        
-        return not df.empty
-    except Exception as e:
-        logger.error(f"❌ Error checking user in space: {e}")
-        return False
-    finally:
-        conn.close()
+    Результат не кешируется: это проверка доступа, а участника может удалить
+    любой воркер API - удаленный участник должен терять доступ сразу.
+    """
+    with get_db_connection() as conn:
+        try:
+            c = conn.cursor()
+            execute_prepared(conn, c, 'is_member', (user_id, space_id))
+            return c.fetchone() is not None
+        except Exception as e:
+            logger.error(f"❌ Error checking user in space: {e}")
+            return False
 
 def is_user_admin_in_space(user_id, space_id):
     """Проверяет, является ли пользователь админом в пространстве"""
-    conn = get_db_connection()
-    
-    try:
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT role FROM space_members WHERE user_id = ? AND space_id = ?'''
-            df = pd.read_sql_query(query, conn, params=(user_id, space_id))
-        else:
-            query = '''SELECT role FROM space_members WHERE user_id = %s AND space_id = %s'''
-            df = pd.read_sql_query(query, conn, params=(user_id, space_id))
-        
-        if not df.empty:
-            role = df.iloc[0]['role']
-            return role in ['owner', 'admin']
-        return False
-    except Exception as e:
-        logger.error(f"❌ Error checking admin rights: {e}")
-        return False
-    finally:
-        conn.close()
+    with get_db_connection() as conn:
+        try:
+            c = conn.cursor()
+            c.execute(_Q_SELECT_ROLE, (space_id, user_id))
+            row = c.fetchone()
+            return row is not None and row[0] in ('owner', 'admin')
+        except Exception as e:
+            logger.error(f"❌ Error checking admin rights: {e}")
+            return False
+
+# Отдельный пул для синхронных запросов из async-обработчиков бота,
+# чтобы OCR и распознавание речи не занимали потоки БД
+DB_WORKERS = 4
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+async def run_db(func, *args):
+    """Выполняет синхронную функцию работы с БД в _DB_EXECUTOR"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_DB_EXECUTOR, func, *args)
+
+# PostgreSQL: пространство и его владелец - одним выражением (writable CTE)
+_Q_CREATE_SPACE = '''WITH ins AS (
+                         INSERT INTO financial_spaces (name, description, space_type, created_by, invite_code)
+                         VALUES (%s, %s, %s, %s, %s) RETURNING id
+                     )
+                     INSERT INTO space_members (space_id, user_id, user_name, role)
+                     SELECT id, %s, %s, 'owner' FROM ins
+                     RETURNING space_id'''
+
+def insert_space_with_owner(conn, c, name, description, space_type, owner_id, owner_name, invite_code):
+    """Создает пространство и добавляет владельца; возвращает ID пространства (без commit)"""
+    c.execute(_Q_CREATE_SPACE, (name, description, space_type, owner_id, invite_code, owner_id, owner_name))
+    return c.fetchone()[0]
 
 def create_personal_space(user_id, user_name):
     """Создание личного пространства"""
-    conn = get_db_connection()
-    
-    try:
-        if isinstance(conn, sqlite3.Connection):
-            c = conn.cursor()
-            c.execute('''INSERT INTO financial_spaces (name, description, space_type, created_by, invite_code)
-                         VALUES (?, ?, ?, ?, ?)''', 
-                     (f"Личное пространство {user_name}", "Ваше личное финансовое пространство", "personal", user_id, f"PERSONAL_{user_id}"))
-            space_id = c.lastrowid
-            
-            c.execute('''INSERT INTO space_members (space_id, user_id, user_name, role)
-                         VALUES (?, ?, ?, ?)''', (space_id, user_id, user_name, 'owner'))
-        else:
+    with get_db_connection() as conn:
+        try:
             c = conn.cursor()
-            c.execute('''INSERT INTO financial_spaces (name, description, space_type, created_by, invite_code)
-                         VALUES (%s, %s, %s, %s, %s) RETURNING id''', 
-                     (f"Личное пространство {user_name}", "Ваше личное финансовое пространство", "personal", user_id, f"PERSONAL_{user_id}"))
-            space_id = c.fetchone()[0]
-            
-            c.execute('''INSERT INTO space_members (space_id, user_id, user_name, role)
-                         VALUES (%s, %s, %s, %s)''', (space_id, user_id, user_name, 'owner'))
-        
-        conn.commit()
-        return space_id
-    except Exception as e:
-        logger.error(f"❌ Ошибка создания личного пространства: {e}")
-        return None
-    finally:
-        conn.close()
+            space_id = insert_space_with_owner(
+                conn, c,
+                f"Личное пространство {user_name}", "Ваше личное финансовое пространство", "personal",
+                user_id, user_name, f"PERSONAL_{user_id}"
+            )
+            conn.commit()
+            return space_id
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания личного пространства: {e}")
+            return None
+
+# Коды приглашений: 8 символов A-Z0-9 (новые - base32 A-Z2-7, см. generate_invite_code)
+INVITE_CODE_LENGTH = 8
+_INVITE_CODE_RE = re.compile(r'\A[A-Z0-9]{8}\Z')
+
+def generate_invite_code():
+    """Случайный код приглашения: base32 от os.urandom (A-Z, 2-7)"""
+    return base64.b32encode(os.urandom(INVITE_CODE_LENGTH * 5 // 8)).decode('ascii')
+
+def is_valid_invite_code(code):
+    """Быстрая проверка формата кода до запроса в БД"""
+    return len(code) == INVITE_CODE_LENGTH and _INVITE_CODE_RE.match(code) is not None
 
 def create_financial_space(name, description, space_type, created_by, created_by_name):
     """Создание нового финансового пространства с улучшенной обработкой ошибок"""
     conn = None
     try:
         conn = get_db_connection()
-        invite_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+        invite_code = generate_invite_code()
         
         logger.info(f"🔧 Создание пространства: {name}, тип: {space_type}, created_by: {created_by}")
         
-        if isinstance(conn, sqlite3.Connection):
-            # SQLite
-            c = conn.cursor()
-            c.execute('''INSERT INTO financial_spaces (name, description, space_type, created_by, invite_code)
-                         VALUES (?, ?, ?, ?, ?)''', 
-                     (name, description, space_type, created_by, invite_code))
-            space_id = c.lastrowid
-            
-            c.execute('''INSERT INTO space_members (space_id, user_id, user_name, role)
-                         VALUES (?, ?, ?, ?)''', 
-                     (space_id, created_by, created_by_name, 'owner'))
-            
-        else:
-            # PostgreSQL
-            c = conn.cursor()
-            c.execute('''INSERT INTO financial_spaces (name, description, space_type, created_by, invite_code)
-                         VALUES (%s, %s, %s, %s, %s) RETURNING id''', 
-                     (name, description, space_type, created_by, invite_code))
-            space_id = c.fetchone()[0]
-            
-            c.execute('''INSERT INTO space_members (space_id, user_id, user_name, role)
-                         VALUES (%s, %s, %s, %s)''', 
-                     (space_id, created_by, created_by_name, 'owner'))
+        c = conn.cursor()
+        space_id = insert_space_with_owner(conn, c, name, description, space_type,
+                                           created_by, created_by_name, invite_code)
         
         conn.commit()
         logger.info(f"✅ Пространство успешно создано: ID {space_id}, код: {invite_code}")
@@ -1245,107 +1421,271 @@ def create_financial_space(name, description, space_type, created_by, created_by
         if conn:
             conn.close()
 
+# Очередь трат из бота: сообщения не ждут INSERT, а пишутся пачками
+EXPENSE_BATCH_SIZE = 100
+EXPENSE_FLUSH_INTERVAL = 0.2  # секунды
+SHUTDOWN_TIMEOUT = 25  # секунды; укладываемся в 30 с между SIGTERM и SIGKILL на Railway/Heroku
+
 def add_expense(user_id, user_name, amount, category, description="", space_id=None, currency="RUB"):
     """Добавление траты в базу"""
-    try:
-        if space_id is None:
-            space_id = ensure_user_has_personal_space(user_id, user_name)
-        
-        logger.info(f"💾 Сохраняем в базу: {user_name} - {amount} {currency} - {category} - space: {space_id}")
-        
-        conn = get_db_connection()
+    add_expenses_bulk([(user_id, user_name, amount, category, description, space_id, currency)])
+
+def add_expense_if_member(user_id, user_name, amount, category, description, space_id, currency="RUB"):
+    """Добавляет трату в пространство, если пользователь в нем состоит; False - нет доступа"""
+    with get_db_connection() as conn:
         c = conn.cursor()
-        
-        if isinstance(conn, sqlite3.Connection):
-            c.execute('''INSERT INTO expenses (user_id, user_name, amount, category, description, space_id, currency)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (user_id, user_name, amount, category, description, space_id, currency))
-        else:
-            c.execute('''INSERT INTO expenses (user_id, user_name, amount, category, description, space_id, currency)
-                         VALUES (%s, %s, %s, %s, %s, %s, %s)''',
-                      (user_id, user_name, amount, category, description, space_id, currency))
-        
+        execute_prepared(conn, c, 'ins_expense_if_member',
+                         (user_id, user_name, amount, category, description, space_id, currency,
+                          user_id, space_id))
+        added = c.rowcount > 0
         conn.commit()
-        conn.close()
-        logger.info(f"✅ Добавлена трата: {user_name} - {amount} {currency} - {category} - space: {space_id}")
-        
+    return added
+
+def add_expenses_bulk(rows):
+    """Добавление пачки трат одной транзакцией.
+    
+    rows - кортежи (user_id, user_name, amount, category, description, space_id, currency).
+    Если пачка не записалась, траты пишутся по одной. Возвращает траты,
+    которые записать не удалось.
+    """
+    failed = []
+    resolved = []
+    for row in rows:
+        if row[5] is None:
+            try:
+                space_id = ensure_user_has_personal_space(row[0], row[1])
+            except Exception as e:
+                logger.error(f"❌ Ошибка получения личного пространства: {e}")
+                space_id = None
+            if space_id is None:
+                logger.error("❌ Нет личного пространства у пользователя %s, трата не записана", row[0])
+                failed.append(row)
+                continue
+            row = row[:5] + (space_id,) + row[6:]
+        resolved.append(row)
+    
+    if not resolved:
+        return failed
+    
+    remaining = list(resolved)  # траты, судьба которых еще не известна
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            try:
+                if len(resolved) == 1:
+                    execute_prepared(conn, c, 'ins_expense', resolved[0])
+                else:
+                    # Один INSERT на всю пачку вместо отдельного EXECUTE на каждую строку
+                    execute_values(c, _Q_INSERT_EXPENSES_VALUES, resolved, page_size=EXPENSE_BATCH_SIZE)
+                conn.commit()
+                logger.info("✅ Добавлено трат одной пачкой: %s", len(resolved))
+                return failed
+            except Exception as e:
+                conn.rollback()
+                if len(resolved) == 1:
+                    logger.error("❌ Трата пользователя %s не записана: %s", resolved[0][0], e)
+                    return failed + resolved
+                logger.warning("⚠️ Пачка из %s трат не записалась (%s), пишу по одной", len(resolved), e)
+            
+            # В пачке траты разных пользователей: одна плохая строка не должна терять остальные
+            while remaining:
+                row = remaining[0]
+                try:
+                    execute_prepared(conn, c, 'ins_expense', row)
+                    conn.commit()
+                except Exception as e:
+                    logger.error("❌ Трата пользователя %s не записана: %s", row[0], e)
+                    failed.append(remaining.pop(0))
+                    conn.rollback()
+                    continue
+                remaining.pop(0)
     except Exception as e:
-        logger.error(f"❌ Ошибка при сохранении в базу: {str(e)}")
+        logger.exception("❌ Ошибка при пакетном сохранении в базу: %s", e)
+        return failed + remaining
+    
+    return failed
+
+FAILED_EXPENSE_TEMPLATE = "❌ Не удалось сохранить трату {amount} ({category}). Пожалуйста, добавьте ее еще раз."
+
+async def notify_failed_expenses(bot, rows):
+    """Сообщает пользователям о тратах, которые не удалось записать.
+    
+    Бот уже ответил "Трата добавлена" при постановке в очередь, поэтому о потере
+    нужно сказать отдельно.
+    """
+    for row in rows:
+        try:
+            await bot.send_message(chat_id=row[0], text=FAILED_EXPENSE_TEMPLATE.format(amount=row[2], category=row[3]))
+        except Exception as e:
+            logger.error(f"❌ Не удалось уведомить {row[0]} о несохраненной трате: {e}")
+
+_expense_queue = None
+_expense_flusher_task = None
+
+def enqueue_expense(user_id, user_name, amount, category, description="", space_id=None, currency="RUB"):
+    """Ставит трату в очередь на запись (без очереди пишет сразу)"""
+    row = (user_id, user_name, amount, category, description, space_id, currency)
+    if _expense_queue is None:
+        add_expense(*row)
+    else:
+        _expense_queue.put_nowait(row)
+
+async def _expense_flusher(bot):
+    """Собирает траты до EXPENSE_BATCH_SIZE штук или EXPENSE_FLUSH_INTERVAL и пишет их"""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    
+    while not stopping:
+        row = await _expense_queue.get()
+        if row is None:
+            break
+        
+        batch = [row]
+        deadline = loop.time() + EXPENSE_FLUSH_INTERVAL
+        while len(batch) < EXPENSE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(_expense_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stopping = True
+                break
+            batch.append(row)
+        
+        failed = await run_db(add_expenses_bulk, batch)
+        if failed:
+            await notify_failed_expenses(bot, failed)
+
+async def start_expense_flusher(application):
+    """post_init: запускает фоновую запись трат"""
+    global _expense_queue, _expense_flusher_task
+    _expense_queue = asyncio.Queue()
+    _expense_flusher_task = asyncio.create_task(_expense_flusher(application.bot))
+    logger.info("✅ Фоновая запись трат запущена")
+
+async def stop_expense_flusher(application):
+    """post_shutdown: дописывает оставшиеся траты"""
+    global _expense_queue, _expense_flusher_task
+    if _expense_flusher_task is None:
+        return
+    
+    _expense_queue.put_nowait(None)
+    try:
+        await asyncio.wait_for(_expense_flusher_task, SHUTDOWN_TIMEOUT)
+        logger.info("✅ Фоновая запись трат остановлена")
+    except asyncio.TimeoutError:
+        logger.error("❌ Запись трат не завершилась за %s с, остаток потерян", SHUTDOWN_TIMEOUT)
+    _expense_queue = None
+    _expense_flusher_task = None
+
+async def on_shutdown(application):
+    """post_shutdown: дописывает траты и останавливает пулы потоков"""
+    await stop_expense_flusher(application)
+    # Обработчики к этому моменту завершены - незапущенные задачи отменяем
+    _MEDIA_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    _VOICE_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    _DB_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+def get_personal_space_id(user_id):
+    """ID активного личного пространства пользователя или None.
+    
+    Не кэшируется: пространство может удалить любой воркер API.
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''SELECT fs.id FROM financial_spaces fs
+                      JOIN space_members sm ON fs.id = sm.space_id
+                      WHERE sm.user_id = %s AND fs.space_type = 'personal' AND fs.is_active = TRUE
+                      LIMIT 1''', (user_id,))
+        row = c.fetchone()
+    
+    return row[0] if row is not None else None
 
 def ensure_user_has_personal_space(user_id, user_name):
     """Гарантирует, что у пользователя есть личное пространство"""
-    conn = get_db_connection()
-    
     try:
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT fs.id FROM financial_spaces fs
-                       JOIN space_members sm ON fs.id = sm.space_id
-                       WHERE sm.user_id = ? AND fs.space_type = 'personal' AND fs.is_active = TRUE'''
-            df = pd.read_sql_query(query, conn, params=(user_id,))
-        else:
-            query = '''SELECT fs.id FROM financial_spaces fs
-                       JOIN space_members sm ON fs.id = sm.space_id
-                       WHERE sm.user_id = %s AND fs.space_type = 'personal' AND fs.is_active = TRUE'''
-            df = pd.read_sql_query(query, conn, params=(user_id,))
-        
-        if not df.empty:
-            return df.iloc[0]['id']
-        else:
-            return create_personal_space(user_id, user_name)
-            
+        space_id = get_personal_space_id(user_id)
+        if space_id is not None:
+            return space_id
     except Exception as e:
         logger.error(f"❌ Error ensuring personal space: {e}")
-        return create_personal_space(user_id, user_name)
-    finally:
-        conn.close()
+    
+    return create_personal_space(user_id, user_name)
+
+def list_user_spaces(user_id):
+    """Активные пространства пользователя списком кортежей:
+    (id, name, description, space_type, invite_code, member_count)
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''SELECT fs.id, fs.name, fs.description, fs.space_type, fs.invite_code,
+                             COUNT(DISTINCT sm.user_id) as member_count
+                      FROM financial_spaces fs
+                      JOIN space_members sm ON fs.id = sm.space_id
+                      WHERE sm.user_id = %s AND fs.is_active = TRUE
+                      GROUP BY fs.id
+                      ORDER BY fs.space_type, fs.created_at DESC''', (user_id,))
+        return c.fetchall()
+
+def list_space_members(space_id):
+    """Участники пространства кортежами (user_id, user_name, role, joined_at),
+    owner и admin первыми.
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''SELECT user_id, user_name, role, joined_at
+                      FROM space_members
+                      WHERE space_id = %s
+                      ORDER BY role_rank, joined_at''', (space_id,))
+        return c.fetchall()
 
 def remove_member_from_space(space_id, user_id, remover_id):
-    """Удаление участника из пространства"""
-    conn = get_db_connection()
+    """Удаление участника из пространства.
     
+    Права удаляющего и роль удаляемого проверяются в самом DELETE,
+    дополнительные SELECT нужны только для текста ошибки.
+    """
     try:
-        if isinstance(conn, sqlite3.Connection):
+        with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute('DELETE FROM space_members WHERE space_id = ? AND user_id = ?', (space_id, user_id))
-        else:
-            c = conn.cursor()
-            c.execute('DELETE FROM space_members WHERE space_id = %s AND user_id = %s', (space_id, user_id))
-        
-        conn.commit()
+            execute_prepared(conn, c, 'delete_member', (space_id, user_id, space_id, remover_id))
+            
+            if c.rowcount == 0:
+                # Сначала права удаляющего: без них не раскрываем, есть ли такой участник
+                execute_prepared(conn, c, 'select_role', (space_id, remover_id))
+                remover = c.fetchone()
+                if remover is None or remover[0] not in ('owner', 'admin'):
+                    conn.rollback()
+                    return False, "Недостаточно прав"
+                execute_prepared(conn, c, 'select_role', (space_id, user_id))
+                row = c.fetchone()
+                conn.rollback()
+                if row is None:
+                    return False, "Участник не найден"
+                if row[0] == 'owner':
+                    return False, "Нельзя удалить владельца"
+                return False, "Недостаточно прав"
+            
+            conn.commit()
         return True, "Участник удален"
     except Exception as e:
         logger.error(f"❌ Error removing member: {e}")
         return False, "Ошибка при удалении"
-    finally:
-        conn.close()
 
 def set_user_budget(user_id, space_id, amount, currency="RUB"):
     """Установка бюджета пользователя на календарный месяц"""
-    conn = get_db_connection()
-    
-    try:
-        # Получаем первый и последний день текущего месяца
-        today = datetime.now()
-        first_day = today.replace(day=1).strftime('%Y-%m-%d')
-        last_day = (today.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
-        last_day = last_day.strftime('%Y-%m-%d')
-        month_year = today.strftime('%Y-%m')
-        
-        if isinstance(conn, sqlite3.Connection):
-            c = conn.cursor()
-            # Проверяем, есть ли уже бюджет на этот месяц
-            c.execute('SELECT id FROM budgets WHERE user_id = ? AND space_id = ? AND month_year = ?', 
-                     (user_id, space_id, month_year))
-            existing = c.fetchone()
-            
-            if existing:
-                c.execute('UPDATE budgets SET amount = ?, currency = ? WHERE id = ?', 
-                         (amount, currency, existing[0]))
-            else:
-                c.execute('''INSERT INTO budgets (user_id, space_id, amount, month_year, currency) 
-                             VALUES (?, ?, ?, ?, ?)''',
-                         (user_id, space_id, amount, month_year, currency))
-        else:
+    with get_db_connection() as conn:
+        try:
+            # Получаем первый и последний день текущего месяца
+            today = datetime.now()
+            first_day = today.replace(day=1).strftime('%Y-%m-%d')
+            last_day = (today.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+            last_day = last_day.strftime('%Y-%m-%d')
+            month_year = today.strftime('%Y-%m')
+        
             c = conn.cursor()
             c.execute('SELECT id FROM budgets WHERE user_id = %s AND space_id = %s AND month_year = %s', 
                      (user_id, space_id, month_year))
@@ -1359,37 +1699,30 @@ def set_user_budget(user_id, space_id, amount, currency="RUB"):
                              VALUES (%s, %s, %s, %s, %s)''',
                          (user_id, space_id, amount, month_year, currency))
         
-        conn.commit()
-        return True
-    except Exception as e:
-        logger.error(f"❌ Error setting budget: {e}")
-        return False
-    finally:
-        conn.close()
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"❌ Error setting budget: {e}")
+            return False
 
 def get_user_budget(user_id, space_id):
     """Получение бюджета пользователя"""
-    conn = get_db_connection()
-    
-    try:
-        current_month = datetime.now().strftime('%Y-%m')
-        
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT amount, currency FROM budgets WHERE user_id = ? AND space_id = ? AND month_year = ?'''
-            df = pd.read_sql_query(query, conn, params=(user_id, space_id, current_month))
-        else:
-            query = '''SELECT amount, currency FROM budgets WHERE user_id = %s AND space_id = %s AND month_year = %s'''
-            df = pd.read_sql_query(query, conn, params=(user_id, space_id, current_month))
-        
-        if not df.empty:
-            return float(df.iloc[0]['amount']), df.iloc[0]['currency']
-        else:
+    with get_db_connection() as conn:
+        try:
+            current_month = datetime.now().strftime('%Y-%m')
+            c = conn.cursor()
+            c.execute('''SELECT amount, currency FROM budgets
+                          WHERE user_id = %s AND space_id = %s AND month_year = %s''',
+                      (user_id, space_id, current_month))
+            row = c.fetchone()
+            
+            if row is not None:
+                return float(row[0]), row[1]
+            else:
+                return 0, 'RUB'
+        except Exception as e:
+            logger.error(f"❌ Error getting budget: {e}")
             return 0, 'RUB'
-    except Exception as e:
-        logger.error(f"❌ Error getting budget: {e}")
-        return 0, 'RUB'
-    finally:
-        conn.close()
 
 # ===== Миграция API endpoints =====
 # ===== Диагностика =====
@@ -1397,15 +1730,7 @@ def get_user_budget(user_id, space_id):
 def debug_database():
     """Диагностика подключения к БД"""
     try:
-        conn = get_db_connection()
-        
-        if isinstance(conn, sqlite3.Connection):
-            db_type = "SQLite"
-            # Проверяем SQLite
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = cursor.fetchall()
-        else:
+        with get_db_connection() as conn:
             db_type = "PostgreSQL"
             # Проверяем PostgreSQL
             cursor = conn.cursor()
@@ -1416,14 +1741,13 @@ def debug_database():
             """)
             tables = cursor.fetchall()
         
-        conn.close()
         
         return jsonify({
             'status': 'success',
             'database_type': db_type,
             'tables': [table[0] for table in tables],
             'tables_count': len(tables),
-            'database_url_exists': 'DATABASE_URL' in os.environ
+            'database_url_exists': DATABASE_URL is not None
         })
         
     except Exception as e:
@@ -1447,18 +1771,17 @@ def admin_init_db():
 def admin_check_tables():
     """Проверка таблиц"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT table_name 
-            FROM information_schema.tables 
-            WHERE table_schema = 'public'
-            ORDER BY table_name
-        """)
+            cursor.execute("""
+                SELECT table_name 
+                FROM information_schema.tables 
+                WHERE table_schema = 'public'
+                ORDER BY table_name
+            """)
         
-        tables = [row[0] for row in cursor.fetchall()]
-        conn.close()
+            tables = [row[0] for row in cursor.fetchall()]
         
         return jsonify({
             "status": "success",
@@ -1476,21 +1799,9 @@ def admin_check_tables():
 def admin_check_db():
     """Проверка состояния базы данных"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        if isinstance(conn, sqlite3.Connection):
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = [row[0] for row in cursor.fetchall()]
-            
-            # Считаем записи
-            cursor.execute("SELECT COUNT(*) FROM financial_spaces")
-            spaces_count = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM expenses")
-            expenses_count = cursor.fetchone()[0]
-            
-        else:
             cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
             tables = [row[0] for row in cursor.fetchall()]
             
@@ -1500,11 +1811,10 @@ def admin_check_db():
             cursor.execute("SELECT COUNT(*) FROM expenses")
             expenses_count = cursor.fetchone()[0]
         
-        conn.close()
         
         return jsonify({
             "status": "success",
-            "database_type": "SQLite" if isinstance(conn, sqlite3.Connection) else "PostgreSQL",
+            "database_type": "PostgreSQL",
             "tables_count": len(tables),
             "tables": tables,
             "spaces_count": spaces_count,
@@ -1524,7 +1834,7 @@ def api_get_advanced_analytics():
         data = request.json
         init_data = data.get('initData')
         space_id = data.get('spaceId')
-        period = data.get('period', 30)
+        period = int(data.get('period', 30))
         analytics_type = data.get('type', 'overview')
         comparison_months = data.get('comparisonMonths', 3)  # количество месяцев для сравнения
         
@@ -1538,101 +1848,49 @@ def api_get_advanced_analytics():
         if space_id and not is_user_in_space(user_data['id'], space_id):
             return jsonify({'error': 'Access denied'}), 403
         
-        conn = get_db_connection()
-        
-        # Получаем первый и последний день текущего месяца
-        today = datetime.now()
-        current_month_start = today.replace(day=1).strftime('%Y-%m-%d')
-        # Последний день месяца
-        if today.month == 12:
-            next_month = today.replace(year=today.year+1, month=1, day=1)
-        else:
-            next_month = today.replace(month=today.month+1, day=1)
-        current_month_end = (next_month - timedelta(days=1)).strftime('%Y-%m-%d')
-        
-        # ===== 1. БАЗОВЫЕ МЕТРИКИ (оригинальный функционал) =====
-        if space_id:
-            # Аналитика для конкретного пространства
-            if isinstance(conn, sqlite3.Connection):
-                # Основные метрики
-                total_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent, 
-                                COUNT(*) as total_count,
-                                AVG(amount) as avg_expense
-                         FROM expenses 
-                         WHERE space_id = ? AND date >= DATE('now', ?)'''
-                total_df = pd.read_sql_query(total_query, conn, params=(space_id, f'-{period} days'))
-                
-                # По категориям
-                categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
-                              FROM expenses 
-                              WHERE space_id = ? AND date >= DATE('now', ?)
-                              GROUP BY category 
-                              ORDER BY total DESC'''
-                categories_df = pd.read_sql_query(categories_query, conn, params=(space_id, f'-{period} days'))
-                
-                # По дням (для графика)
-                daily_query = '''SELECT DATE(date) as day, SUM(amount) as total
-                         FROM expenses 
-                         WHERE space_id = ? AND date >= DATE('now', ?)
-                         GROUP BY DATE(date) 
-                         ORDER BY day'''
-                daily_df = pd.read_sql_query(daily_query, conn, params=(space_id, f'-{period} days'))
-                
-                # По участникам
-                members_query = '''SELECT user_name, SUM(amount) as total, COUNT(*) as count
-                           FROM expenses 
-                           WHERE space_id = ? AND date >= DATE('now', ?)
-                           GROUP BY user_name 
-                           ORDER BY total DESC'''
-                members_df = pd.read_sql_query(members_query, conn, params=(space_id, f'-{period} days'))
-                
-                # ===== ДАННЫЕ ДЛЯ ТЕКУЩЕГО МЕСЯЦА =====
-                current_month_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent,
-                                        COUNT(*) as total_count,
-                                        AVG(amount) as avg_expense
-                                 FROM expenses 
-                                 WHERE space_id = ? AND date >= ? AND date <= ?'''
-                current_month_df = pd.read_sql_query(current_month_query, conn, 
-                                                    params=(space_id, current_month_start, current_month_end))
-                
-                # По категориям за текущий месяц
-                current_month_categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
-                                          FROM expenses 
-                                          WHERE space_id = ? AND date >= ? AND date <= ?
-                                          GROUP BY category 
-                                          ORDER BY total DESC'''
-                current_month_categories_df = pd.read_sql_query(current_month_categories_query, conn,
-                                                               params=(space_id, current_month_start, current_month_end))
-                
+        with get_db_connection() as conn:
+            # Получаем первый и последний день текущего месяца
+            today = datetime.now()
+            current_month_start = today.replace(day=1).strftime('%Y-%m-%d')
+            # Последний день месяца
+            if today.month == 12:
+                next_month = today.replace(year=today.year+1, month=1, day=1)
             else:
-                # PostgreSQL версия
+                next_month = today.replace(month=today.month+1, day=1)
+            current_month_end = (next_month - timedelta(days=1)).strftime('%Y-%m-%d')
+        
+            # ===== 1. БАЗОВЫЕ МЕТРИКИ (оригинальный функционал) =====
+            if space_id:
+                # Аналитика для конкретного пространства
                 total_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent, 
                                 COUNT(*) as total_count,
                                 AVG(amount) as avg_expense
                          FROM expenses 
-                         WHERE space_id = %s AND date >= CURRENT_DATE - INTERVAL %s'''
-                total_df = pd.read_sql_query(total_query, conn, params=(space_id, f'{period} days'))
+                         WHERE space_id = %s AND date >= CURRENT_DATE - (%s * INTERVAL '1 day')'''
+                total_df = pd.read_sql_query(total_query, conn, params=(space_id, period))
                 
-                categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
+                categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count,
+                                     COALESCE(SUM(amount) * 1.0 / NULLIF(SUM(SUM(amount)) OVER (), 0), 0) as share
                               FROM expenses 
-                              WHERE space_id = %s AND date >= CURRENT_DATE - INTERVAL %s
+                              WHERE space_id = %s AND date >= CURRENT_DATE - (%s * INTERVAL '1 day')
                               GROUP BY category 
                               ORDER BY total DESC'''
-                categories_df = pd.read_sql_query(categories_query, conn, params=(space_id, f'{period} days'))
+                categories_df = pd.read_sql_query(categories_query, conn, params=(space_id, period))
                 
                 daily_query = '''SELECT DATE(date) as day, SUM(amount) as total
                          FROM expenses 
-                         WHERE space_id = %s AND date >= CURRENT_DATE - INTERVAL %s
+                         WHERE space_id = %s AND date >= CURRENT_DATE - (%s * INTERVAL '1 day')
                          GROUP BY DATE(date) 
                          ORDER BY day'''
-                daily_df = pd.read_sql_query(daily_query, conn, params=(space_id, f'{period} days'))
+                daily_df = pd.read_sql_query(daily_query, conn, params=(space_id, period))
                 
-                members_query = '''SELECT user_name, SUM(amount) as total, COUNT(*) as count
+                members_query = '''SELECT user_name, SUM(amount) as total, COUNT(*) as count,
+                                  COALESCE(SUM(amount) * 1.0 / NULLIF(SUM(SUM(amount)) OVER (), 0), 0) as share
                            FROM expenses 
-                           WHERE space_id = %s AND date >= CURRENT_DATE - INTERVAL %s
+                           WHERE space_id = %s AND date >= CURRENT_DATE - (%s * INTERVAL '1 day')
                            GROUP BY user_name 
                            ORDER BY total DESC'''
-                members_df = pd.read_sql_query(members_query, conn, params=(space_id, f'{period} days'))
+                members_df = pd.read_sql_query(members_query, conn, params=(space_id, period))
                 
                 # ===== ДАННЫЕ ДЛЯ ТЕКУЩЕГО МЕСЯЦА =====
                 current_month_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent,
@@ -1644,76 +1902,37 @@ def api_get_advanced_analytics():
                                                     params=(space_id, current_month_start, current_month_end))
                 
                 # По категориям за текущий месяц
-                current_month_categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
+                current_month_categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count,
+                                     COALESCE(SUM(amount) * 1.0 / NULLIF(SUM(SUM(amount)) OVER (), 0), 0) as share
                                           FROM expenses 
                                           WHERE space_id = %s AND date >= %s AND date <= %s
                                           GROUP BY category 
                                           ORDER BY total DESC'''
                 current_month_categories_df = pd.read_sql_query(current_month_categories_query, conn,
                                                                params=(space_id, current_month_start, current_month_end))
-        else:
-            # Аналитика всех пространств пользователя
-            if isinstance(conn, sqlite3.Connection):
-                total_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent, 
-                                COUNT(*) as total_count,
-                                AVG(amount) as avg_expense
-                         FROM expenses 
-                         WHERE user_id = ? AND date >= DATE('now', ?)'''
-                total_df = pd.read_sql_query(total_query, conn, params=(user_data['id'], f'-{period} days'))
-                
-                categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
-                              FROM expenses 
-                              WHERE user_id = ? AND date >= DATE('now', ?)
-                              GROUP BY category 
-                              ORDER BY total DESC'''
-                categories_df = pd.read_sql_query(categories_query, conn, params=(user_data['id'], f'-{period} days'))
-                
-                daily_query = '''SELECT DATE(date) as day, SUM(amount) as total
-                         FROM expenses 
-                         WHERE user_id = ? AND date >= DATE('now', ?)
-                         GROUP BY DATE(date) 
-                         ORDER BY day'''
-                daily_df = pd.read_sql_query(daily_query, conn, params=(user_data['id'], f'-{period} days'))
-                
-                # ===== ДАННЫЕ ДЛЯ ТЕКУЩЕГО МЕСЯЦА =====
-                current_month_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent,
-                                        COUNT(*) as total_count,
-                                        AVG(amount) as avg_expense
-                                 FROM expenses 
-                                 WHERE user_id = ? AND date >= ? AND date <= ?'''
-                current_month_df = pd.read_sql_query(current_month_query, conn,
-                                                    params=(user_data['id'], current_month_start, current_month_end))
-                
-                # По категориям за текущий месяц
-                current_month_categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
-                                          FROM expenses 
-                                          WHERE user_id = ? AND date >= ? AND date <= ?
-                                          GROUP BY category 
-                                          ORDER BY total DESC'''
-                current_month_categories_df = pd.read_sql_query(current_month_categories_query, conn,
-                                                               params=(user_data['id'], current_month_start, current_month_end))
-                
             else:
+                # Аналитика всех пространств пользователя
                 total_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent, 
                                 COUNT(*) as total_count,
                                 AVG(amount) as avg_expense
                          FROM expenses 
-                         WHERE user_id = %s AND date >= CURRENT_DATE - INTERVAL %s'''
-                total_df = pd.read_sql_query(total_query, conn, params=(user_data['id'], f'{period} days'))
+                         WHERE user_id = %s AND date >= CURRENT_DATE - (%s * INTERVAL '1 day')'''
+                total_df = pd.read_sql_query(total_query, conn, params=(user_data['id'], period))
                 
-                categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
+                categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count,
+                                     COALESCE(SUM(amount) * 1.0 / NULLIF(SUM(SUM(amount)) OVER (), 0), 0) as share
                               FROM expenses 
-                              WHERE user_id = %s AND date >= CURRENT_DATE - INTERVAL %s
+                              WHERE user_id = %s AND date >= CURRENT_DATE - (%s * INTERVAL '1 day')
                               GROUP BY category 
                               ORDER BY total DESC'''
-                categories_df = pd.read_sql_query(categories_query, conn, params=(user_data['id'], f'{period} days'))
+                categories_df = pd.read_sql_query(categories_query, conn, params=(user_data['id'], period))
                 
                 daily_query = '''SELECT DATE(date) as day, SUM(amount) as total
                          FROM expenses 
-                         WHERE user_id = %s AND date >= CURRENT_DATE - INTERVAL %s
+                         WHERE user_id = %s AND date >= CURRENT_DATE - (%s * INTERVAL '1 day')
                          GROUP BY DATE(date) 
                          ORDER BY day'''
-                daily_df = pd.read_sql_query(daily_query, conn, params=(user_data['id'], f'{period} days'))
+                daily_df = pd.read_sql_query(daily_query, conn, params=(user_data['id'], period))
                 
                 # ===== ДАННЫЕ ДЛЯ ТЕКУЩЕГО МЕСЯЦА =====
                 current_month_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent,
@@ -1725,7 +1944,8 @@ def api_get_advanced_analytics():
                                                     params=(user_data['id'], current_month_start, current_month_end))
                 
                 # По категориям за текущий месяц
-                current_month_categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
+                current_month_categories_query = '''SELECT category, SUM(amount) as total, COUNT(*) as count,
+                                     COALESCE(SUM(amount) * 1.0 / NULLIF(SUM(SUM(amount)) OVER (), 0), 0) as share
                                           FROM expenses 
                                           WHERE user_id = %s AND date >= %s AND date <= %s
                                           GROUP BY category 
@@ -1733,44 +1953,26 @@ def api_get_advanced_analytics():
                 current_month_categories_df = pd.read_sql_query(current_month_categories_query, conn,
                                                                params=(user_data['id'], current_month_start, current_month_end))
         
-        # ===== 2. НОВЫЙ ФУНКЦИОНАЛ: СРАВНЕНИЕ ПО МЕСЯЦАМ =====
-        monthly_comparison = []
+            # ===== 2. НОВЫЙ ФУНКЦИОНАЛ: СРАВНЕНИЕ ПО МЕСЯЦАМ =====
+            monthly_comparison = []
         
-        # Получаем данные за последние N месяцев
-        for i in range(comparison_months):
-            month_date = today.replace(day=1) - timedelta(days=30*i)
-            month_start = month_date.replace(day=1).strftime('%Y-%m-%d')
+            # Получаем данные за последние N месяцев
+            for i in range(comparison_months):
+                month_date = today.replace(day=1) - timedelta(days=30*i)
+                month_start = month_date.replace(day=1).strftime('%Y-%m-%d')
             
-            # Последний день месяца
-            if month_date.month == 12:
-                next_month = month_date.replace(year=month_date.year+1, month=1, day=1)
-            else:
-                next_month = month_date.replace(month=month_date.month+1, day=1)
-            month_end = (next_month - timedelta(days=1)).strftime('%Y-%m-%d')
+                # Последний день месяца
+                if month_date.month == 12:
+                    next_month = month_date.replace(year=month_date.year+1, month=1, day=1)
+                else:
+                    next_month = month_date.replace(month=month_date.month+1, day=1)
+                month_end = (next_month - timedelta(days=1)).strftime('%Y-%m-%d')
             
-            month_name = month_date.strftime('%B %Y')
-            month_short = month_date.strftime('%Y-%m')
+                month_name = month_date.strftime('%B %Y')
+                month_short = month_date.strftime('%Y-%m')
             
-            if space_id:
-                # Для конкретного пространства
-                if isinstance(conn, sqlite3.Connection):
-                    month_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent,
-                                            COUNT(*) as total_count,
-                                            AVG(amount) as avg_expense
-                                     FROM expenses 
-                                     WHERE space_id = ? AND date >= ? AND date <= ?'''
-                    month_df = pd.read_sql_query(month_query, conn, params=(space_id, month_start, month_end))
-                    
-                    # Категории за месяц
-                    month_categories_query = '''SELECT category, SUM(amount) as total
-                                              FROM expenses 
-                                              WHERE space_id = ? AND date >= ? AND date <= ?
-                                              GROUP BY category 
-                                              ORDER BY total DESC
-                                              LIMIT 5'''
-                    month_categories_df = pd.read_sql_query(month_categories_query, conn, 
-                                                           params=(space_id, month_start, month_end))
-                else:
+                if space_id:
+                    # Для конкретного пространства
                     month_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent,
                                             COUNT(*) as total_count,
                                             AVG(amount) as avg_expense
@@ -1786,25 +1988,8 @@ def api_get_advanced_analytics():
                                               LIMIT 5'''
                     month_categories_df = pd.read_sql_query(month_categories_query, conn,
                                                            params=(space_id, month_start, month_end))
-            else:
-                # Для всех пространств пользователя
-                if isinstance(conn, sqlite3.Connection):
-                    month_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent,
-                                            COUNT(*) as total_count,
-                                            AVG(amount) as avg_expense
-                                     FROM expenses 
-                                     WHERE user_id = ? AND date >= ? AND date <= ?'''
-                    month_df = pd.read_sql_query(month_query, conn, params=(user_data['id'], month_start, month_end))
-                    
-                    month_categories_query = '''SELECT category, SUM(amount) as total
-                                              FROM expenses 
-                                              WHERE user_id = ? AND date >= ? AND date <= ?
-                                              GROUP BY category 
-                                              ORDER BY total DESC
-                                              LIMIT 5'''
-                    month_categories_df = pd.read_sql_query(month_categories_query, conn,
-                                                           params=(user_data['id'], month_start, month_end))
                 else:
+                    # Для всех пространств пользователя
                     month_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent,
                                             COUNT(*) as total_count,
                                             AVG(amount) as avg_expense
@@ -1821,47 +2006,46 @@ def api_get_advanced_analytics():
                     month_categories_df = pd.read_sql_query(month_categories_query, conn,
                                                            params=(user_data['id'], month_start, month_end))
             
-            if not month_df.empty:
-                # Получаем топ-5 категорий для месяца
-                month_categories = []
-                for _, cat_row in month_categories_df.iterrows():
-                    month_categories.append({
-                        'name': cat_row['category'],
-                        'total': float(cat_row['total'])
-                    })
+                if not month_df.empty:
+                    # Получаем топ-5 категорий для месяца
+                    month_categories = []
+                    for _, cat_row in month_categories_df.iterrows():
+                        month_categories.append({
+                            'name': cat_row['category'],
+                            'total': float(cat_row['total'])
+                        })
                 
-                monthly_comparison.append({
-                    'month': month_name,
-                    'month_short': month_short,
-                    'month_start': month_start,
-                    'month_end': month_end,
-                    'total_spent': float(month_df.iloc[0]['total_spent']),
-                    'total_count': int(month_df.iloc[0]['total_count']),
-                    'avg_expense': float(month_df.iloc[0]['avg_expense']) if not pd.isna(month_df.iloc[0]['avg_expense']) else 0,
-                    'top_categories': month_categories
-                })
+                    monthly_comparison.append({
+                        'month': month_name,
+                        'month_short': month_short,
+                        'month_start': month_start,
+                        'month_end': month_end,
+                        'total_spent': float(month_df.iloc[0]['total_spent']),
+                        'total_count': int(month_df.iloc[0]['total_count']),
+                        'avg_expense': float(month_df.iloc[0]['avg_expense']) if not pd.isna(month_df.iloc[0]['avg_expense']) else 0,
+                        'top_categories': month_categories
+                    })
         
-        # Сортируем месяцы по возрастанию (от старых к новым)
-        monthly_comparison.reverse()
+            # Сортируем месяцы по возрастанию (от старых к новым)
+            monthly_comparison.reverse()
         
-        # ===== 3. РАСЧЕТ ИЗМЕНЕНИЙ МЕЖДУ МЕСЯЦАМИ =====
-        month_over_month_changes = []
-        for i in range(1, len(monthly_comparison)):
-            current = monthly_comparison[i]
-            previous = monthly_comparison[i-1]
+            # ===== 3. РАСЧЕТ ИЗМЕНЕНИЙ МЕЖДУ МЕСЯЦАМИ =====
+            month_over_month_changes = []
+            for i in range(1, len(monthly_comparison)):
+                current = monthly_comparison[i]
+                previous = monthly_comparison[i-1]
             
-            change = current['total_spent'] - previous['total_spent']
-            change_percent = (change / previous['total_spent'] * 100) if previous['total_spent'] > 0 else 0
+                change = current['total_spent'] - previous['total_spent']
+                change_percent = (change / previous['total_spent'] * 100) if previous['total_spent'] > 0 else 0
             
-            month_over_month_changes.append({
-                'month': current['month'],
-                'previous_month': previous['month'],
-                'change': change,
-                'change_percent': change_percent,
-                'trend': 'up' if change > 0 else 'down' if change < 0 else 'stable'
-            })
+                month_over_month_changes.append({
+                    'month': current['month'],
+                    'previous_month': previous['month'],
+                    'change': change,
+                    'change_percent': change_percent,
+                    'trend': 'up' if change > 0 else 'down' if change < 0 else 'stable'
+                })
         
-        conn.close()
         
         # ===== 4. ФОРМИРУЕМ ОТВЕТ (сохраняя всю оригинальную структуру) =====
         result = {
@@ -1898,33 +2082,25 @@ def api_get_advanced_analytics():
             }
         }
         
+        # Доли (share) считаются в SQL оконной функцией - здесь только упаковка
         # Категории за период (оригинальный функционал)
-        for _, row in categories_df.iterrows():
-            result['categories'].append({
-                'name': row['category'],
-                'total': float(row['total']),
-                'count': int(row['count']),
-                'percentage': float(row['total']) / result['overview']['total_spent'] if result['overview']['total_spent'] > 0 else 0
-            })
+        result['categories'] = [
+            {'name': name, 'total': float(total), 'count': int(count), 'percentage': float(share)}
+            for name, total, count, share in categories_df.itertuples(index=False)
+        ]
         
         # Категории за текущий месяц
-        for _, row in current_month_categories_df.iterrows():
-            result['current_month']['categories'].append({
-                'name': row['category'],
-                'total': float(row['total']),
-                'count': int(row['count']),
-                'percentage': float(row['total']) / result['current_month']['total_spent'] if result['current_month']['total_spent'] > 0 else 0
-            })
+        result['current_month']['categories'] = [
+            {'name': name, 'total': float(total), 'count': int(count), 'percentage': float(share)}
+            for name, total, count, share in current_month_categories_df.itertuples(index=False)
+        ]
         
         # Участники (только для пространств) - оригинальный функционал
         if space_id and not members_df.empty:
-            for _, row in members_df.iterrows():
-                result['members'].append({
-                    'name': row['user_name'],
-                    'total': float(row['total']),
-                    'count': int(row['count']),
-                    'percentage': float(row['total']) / result['overview']['total_spent'] if result['overview']['total_spent'] > 0 else 0
-                })
+            result['members'] = [
+                {'name': name, 'total': float(total), 'count': int(count), 'percentage': float(share)}
+                for name, total, count, share in members_df.itertuples(index=False)
+            ]
         
         # Добавляем бюджет пользователя для текущего месяца
         if space_id:
@@ -1964,32 +2140,18 @@ def api_compare_months():
         if space_id and not is_user_in_space(user_data['id'], space_id):
             return jsonify({'error': 'Access denied'}), 403
         
-        conn = get_db_connection()
-        
-        comparison_data = []
-        today = datetime.now()
+        with get_db_connection() as conn:
+            comparison_data = []
+            today = datetime.now()
         
-        for i in range(months - 1, -1, -1):  # От старых к новым
-            month_date = today.replace(day=1) - timedelta(days=30*i)
-            month_start = month_date.replace(day=1).strftime('%Y-%m-%d')
-            month_end = (month_date.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
-            month_end = month_end.strftime('%Y-%m-%d')
-            month_name = month_date.strftime('%B %Y')
+            for i in range(months - 1, -1, -1):  # От старых к новым
+                month_date = today.replace(day=1) - timedelta(days=30*i)
+                month_start = month_date.replace(day=1).strftime('%Y-%m-%d')
+                month_end = (month_date.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+                month_end = month_end.strftime('%Y-%m-%d')
+                month_name = month_date.strftime('%B %Y')
             
-            if space_id:
-                if isinstance(conn, sqlite3.Connection):
-                    query = '''SELECT category, SUM(amount) as total
-                              FROM expenses 
-                              WHERE space_id = ? AND date >= ? AND date <= ?
-                              GROUP BY category
-                              ORDER BY total DESC'''
-                    month_df = pd.read_sql_query(query, conn, params=(space_id, month_start, month_end))
-                    
-                    total_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent
-                                    FROM expenses 
-                                    WHERE space_id = ? AND date >= ? AND date <= ?'''
-                    total_df = pd.read_sql_query(total_query, conn, params=(space_id, month_start, month_end))
-                else:
+                if space_id:
                     query = '''SELECT category, SUM(amount) as total
                               FROM expenses 
                               WHERE space_id = %s AND date >= %s AND date <= %s
@@ -2001,19 +2163,6 @@ def api_compare_months():
                                     FROM expenses 
                                     WHERE space_id = %s AND date >= %s AND date <= %s'''
                     total_df = pd.read_sql_query(total_query, conn, params=(space_id, month_start, month_end))
-            else:
-                if isinstance(conn, sqlite3.Connection):
-                    query = '''SELECT category, SUM(amount) as total
-                              FROM expenses 
-                              WHERE user_id = ? AND date >= ? AND date <= ?
-                              GROUP BY category
-                              ORDER BY total DESC'''
-                    month_df = pd.read_sql_query(query, conn, params=(user_data['id'], month_start, month_end))
-                    
-                    total_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent
-                                    FROM expenses 
-                                    WHERE user_id = ? AND date >= ? AND date <= ?'''
-                    total_df = pd.read_sql_query(total_query, conn, params=(user_data['id'], month_start, month_end))
                 else:
                     query = '''SELECT category, SUM(amount) as total
                               FROM expenses 
@@ -2027,22 +2176,21 @@ def api_compare_months():
                                     WHERE user_id = %s AND date >= %s AND date <= %s'''
                     total_df = pd.read_sql_query(total_query, conn, params=(user_data['id'], month_start, month_end))
             
-            categories = []
-            for _, row in month_df.iterrows():
-                categories.append({
-                    'name': row['category'],
-                    'total': float(row['total'])
-                })
+                categories = []
+                for _, row in month_df.iterrows():
+                    categories.append({
+                        'name': row['category'],
+                        'total': float(row['total'])
+                    })
             
-            comparison_data.append({
-                'month': month_name,
-                'month_start': month_start,
-                'month_end': month_end,
-                'total_spent': float(total_df.iloc[0]['total_spent']) if not total_df.empty else 0,
-                'categories': categories
-            })
+                comparison_data.append({
+                    'month': month_name,
+                    'month_start': month_start,
+                    'month_end': month_end,
+                    'total_spent': float(total_df.iloc[0]['total_spent']) if not total_df.empty else 0,
+                    'categories': categories
+                })
         
-        conn.close()
         
         # Рассчитываем изменения
         if len(comparison_data) >= 2:
@@ -2085,46 +2233,18 @@ def api_get_user_categories():
         if not user_data:
             return jsonify({'error': 'User not found'}), 401
         
-        conn = get_db_connection()
-        
-        # Получаем стандартные категории
-        if isinstance(conn, sqlite3.Connection):
-            default_query = '''SELECT category_name, category_icon FROM user_categories 
-                             WHERE is_custom = FALSE'''
-            default_df = pd.read_sql_query(default_query, conn)
-            
-            # Получаем пользовательские категории
-            custom_query = '''SELECT category_name, category_icon FROM user_categories 
-                            WHERE user_id = ? AND (space_id = ? OR space_id = 0) AND is_custom = TRUE'''
-            custom_df = pd.read_sql_query(custom_query, conn, params=(user_data['id'], space_id if space_id else 0))
-        else:
-            default_query = '''SELECT category_name, category_icon FROM user_categories 
-                             WHERE is_custom = FALSE'''
-            default_df = pd.read_sql_query(default_query, conn)
-            
-            custom_query = '''SELECT category_name, category_icon FROM user_categories 
-                            WHERE user_id = %s AND (space_id = %s OR space_id = 0) AND is_custom = TRUE'''
-            custom_df = pd.read_sql_query(custom_query, conn, params=(user_data['id'], space_id if space_id else 0))
-        
-        conn.close()
-        
-        categories = []
-        
-        # Добавляем стандартные категории
-        for _, row in default_df.iterrows():
-            categories.append({
-                'name': row['category_name'],
-                'icon': row['category_icon'],
-                'isCustom': False
-            })
-        
-        # Добавляем пользовательские категории
-        for _, row in custom_df.iterrows():
-            categories.append({
-                'name': row['category_name'],
-                'icon': row['category_icon'],
-                'isCustom': True
-            })
+        with get_db_connection() as conn:
+            # Стандартные и пользовательские категории одним запросом, стандартные - первыми
+            c = conn.cursor()
+            c.execute('''SELECT category_name, category_icon, is_custom FROM user_categories 
+                          WHERE is_custom = FALSE
+                             OR (user_id = %s AND (space_id = %s OR space_id = 0) AND is_custom = TRUE)
+                          ORDER BY is_custom''',
+                      (user_data['id'], space_id if space_id else 0))
+            categories = [
+                {'name': name, 'icon': icon, 'isCustom': bool(is_custom)}
+                for name, icon, is_custom in c.fetchall()
+            ]
         
         return jsonify({'categories': categories})
         
@@ -2152,19 +2272,12 @@ def api_add_user_category():
         if not category_name:
             return jsonify({'error': 'Category name is required'}), 400
         
-        conn = get_db_connection()
-        
-        if isinstance(conn, sqlite3.Connection):
-            conn.execute('''INSERT INTO user_categories (user_id, space_id, category_name, category_icon, is_custom)
-                         VALUES (?, ?, ?, ?, TRUE)''',
-                      (user_data['id'], space_id if space_id else 0, category_name, category_icon))
-        else:
+        with get_db_connection() as conn:
             conn.cursor().execute('''INSERT INTO user_categories (user_id, space_id, category_name, category_icon, is_custom)
                          VALUES (%s, %s, %s, %s, TRUE)''',
                       (user_data['id'], space_id if space_id else 0, category_name, category_icon))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         
         return jsonify({'success': True, 'message': 'Категория добавлена'})
         
@@ -2181,7 +2294,7 @@ def api_export_to_excel():
         data = request.json
         init_data = data.get('initData')
         space_id = data.get('spaceId')
-        period = data.get('period', 30)
+        period = int(data.get('period', 30))
         
         if not validate_webapp_data(init_data):
             return jsonify({'error': 'Invalid data'}), 401
@@ -2191,24 +2304,14 @@ def api_export_to_excel():
             return jsonify({'error': 'User not found'}), 401
         
         # Получаем данные из БД с комментариями
-        conn = get_db_connection()
-        
-        if isinstance(conn, sqlite3.Connection):
+        with get_db_connection() as conn:
             query = '''SELECT e.date, e.amount, e.currency, e.category, e.description, e.user_name, fs.name as space_name
                       FROM expenses e
                       JOIN financial_spaces fs ON e.space_id = fs.id
-                      WHERE e.space_id = ? AND e.date >= DATE('now', ?)
-                      ORDER BY e.date DESC'''
-            df = pd.read_sql_query(query, conn, params=(space_id, f'-{period} days'))
-        else:
-            query = '''SELECT e.date, e.amount, e.currency, e.category, e.description, e.user_name, fs.name as space_name
-                      FROM expenses e
-                      JOIN financial_spaces fs ON e.space_id = fs.id
-                      WHERE e.space_id = %s AND e.date >= CURRENT_DATE - INTERVAL '%s days'
+                      WHERE e.space_id = %s AND e.date >= CURRENT_DATE - (%s * INTERVAL '1 day')
                       ORDER BY e.date DESC'''
             df = pd.read_sql_query(query, conn, params=(space_id, period))
         
-        conn.close()
         
         logger.info(f"📊 Found {len(df)} records")
         
@@ -2217,7 +2320,9 @@ def api_export_to_excel():
         
         # Создаем Excel с комментариями
         output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        # Без constant_memory: to_excel пишет тело по столбцам, а в этом режиме
+        # xlsxwriter молча пропускает запись в уже сброшенные строки
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
             # Основной лист с тратами
             df.to_excel(writer, sheet_name='Траты', index=False)
             
@@ -2256,11 +2361,6 @@ def api_export_to_excel():
         excel_data = output.getvalue()
         logger.info(f"✅ Excel created with comments, size: {len(excel_data)} bytes")
         
-        # Сохраняем файл временно
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as temp_file:
-            temp_file.write(excel_data)
-            temp_path = temp_file.name
-        
         # Отправляем файл через Telegram Bot
         try:
             from telegram import Bot
@@ -2270,53 +2370,43 @@ def api_export_to_excel():
             user_id = user_data['id']
             filename = f"finance_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
             
-            # Используем синхронную отправку
-            with open(temp_path, 'rb') as file:
-                # Создаем event loop для синхронной отправки
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-                try:
-                    loop.run_until_complete(
-                        bot.send_document(
-                            chat_id=user_id,
-                            document=file,
-                            filename=filename,
-                            caption=f"📊 Финансовый отчет\n💼 Пространство ID: {space_id}\n📅 Период: {period} дней\n📈 Записей: {len(df)}\n💬 Трат с комментариями: {total_with_comments}"
-                        )
+            # Отправляем прямо из памяти, без временного файла
+            output.seek(0)
+            # Создаем event loop для синхронной отправки
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                loop.run_until_complete(
+                    bot.send_document(
+                        chat_id=user_id,
+                        document=output,
+                        filename=filename,
+                        caption=f"📊 Финансовый отчет\n💼 Пространство ID: {space_id}\n📅 Период: {period} дней\n📈 Записей: {len(df)}\n💬 Трат с комментариями: {total_with_comments}"
                     )
-                    logger.info(f"✅ File sent via Telegram bot to user {user_id}")
-                    
-                    # Удаляем временный файл
-                    import os
-                    os.unlink(temp_path)
-                    
-                    return jsonify({
-                        'success': True,
-                        'message': 'Файл отправлен в чат с ботом! Проверьте Telegram.',
-                        'sent_via_bot': True,
-                        'stats': {
-                            'total_expenses': len(df),
-                            'expenses_with_comments': total_with_comments,
-                            'total_amount': df['amount'].sum(),
-                            'period_days': period
-                        }
-                    })
-                    
-                finally:
-                    loop.close()
-                    
+                )
+                logger.info(f"✅ File sent via Telegram bot to user {user_id}")
+                
+                return jsonify({
+                    'success': True,
+                    'message': 'Файл отправлен в чат с ботом! Проверьте Telegram.',
+                    'sent_via_bot': True,
+                    'stats': {
+                        'total_expenses': len(df),
+                        'expenses_with_comments': total_with_comments,
+                        'total_amount': df['amount'].sum(),
+                        'period_days': period
+                    }
+                })
+                
+            finally:
+                loop.close()
+                
         except Exception as e:
             logger.error(f"❌ Telegram send failed: {e}")
             # Если не удалось отправить через бота, возвращаем base64
-            import base64
             excel_b64 = base64.b64encode(excel_data).decode('utf-8')
             
-            # Удаляем временный файл
-            import os
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
-            
             return jsonify({
                 'success': True,
                 'message': 'Файл готов к скачиванию',
@@ -2345,7 +2435,7 @@ def api_get_expenses_list():
         data = request.json
         init_data = data.get('initData')
         space_id = data.get('spaceId')
-        period = data.get('period', 30)
+        period = int(data.get('period', 30))
         
         if not validate_webapp_data(init_data):
             return jsonify({'error': 'Invalid data'}), 401
@@ -2357,23 +2447,14 @@ def api_get_expenses_list():
         if space_id and not is_user_in_space(user_data['id'], space_id):
             return jsonify({'error': 'Access denied'}), 403
         
-        conn = get_db_connection()
-        
-        # ВАЖНО: Добавляем e.id в SELECT!
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT e.id, e.date, e.amount, e.currency, e.category, e.description, e.user_name
-                      FROM expenses e
-                      WHERE e.space_id = ? AND e.date >= DATE('now', ?)
-                      ORDER BY e.date DESC'''
-            df = pd.read_sql_query(query, conn, params=(space_id, f'-{period} days'))
-        else:
+        with get_db_connection() as conn:
+            # ВАЖНО: Добавляем e.id в SELECT!
             query = '''SELECT e.id, e.date, e.amount, e.currency, e.category, e.description, e.user_name
                       FROM expenses e
-                      WHERE e.space_id = %s AND e.date >= CURRENT_DATE - INTERVAL '%s days'
+                      WHERE e.space_id = %s AND e.date >= CURRENT_DATE - (%s * INTERVAL '1 day')
                       ORDER BY e.date DESC'''
             df = pd.read_sql_query(query, conn, params=(space_id, period))
         
-        conn.close()
         
         # Преобразуем в список словарей
         expenses = []
@@ -2436,56 +2517,40 @@ def api_delete_expense():
         user_id = user_data['id']
         print(f"👤 User ID: {user_id}")
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # ПРОВЕРКА 1: Существует ли трата
-        if isinstance(conn, sqlite3.Connection):
-            cursor.execute('SELECT id, user_id, space_id FROM expenses WHERE id = ?', (expense_id,))
-        else:
+            # ПРОВЕРКА 1: Существует ли трата
             cursor.execute('SELECT id, user_id, space_id FROM expenses WHERE id = %s', (expense_id,))
         
-        expense = cursor.fetchone()
-        print(f"📊 Expense check: {expense}")
+            expense = cursor.fetchone()
+            print(f"📊 Expense check: {expense}")
         
-        if not expense:
-            conn.close()
-            print(f"❌ ERROR: Expense {expense_id} not found in database")
-            return jsonify({'error': 'Трата не найдена'}), 404
+            if not expense:
+                print(f"❌ ERROR: Expense {expense_id} not found in database")
+                return jsonify({'error': 'Трата не найдена'}), 404
         
-        # ПРОВЕРКА 2: Имеет ли пользователь права на удаление
-        # Вариант 1: Пользователь создал трату
-        # Вариант 2: Пользователь состоит в пространстве траты
-        if isinstance(conn, sqlite3.Connection):
-            cursor.execute('''
-                SELECT e.id FROM expenses e 
-                LEFT JOIN space_members sm ON e.space_id = sm.space_id 
-                WHERE e.id = ? AND (e.user_id = ? OR sm.user_id = ?)
-            ''', (expense_id, user_id, user_id))
-        else:
+            # ПРОВЕРКА 2: Имеет ли пользователь права на удаление
+            # Вариант 1: Пользователь создал трату
+            # Вариант 2: Пользователь состоит в пространстве траты
             cursor.execute('''
                 SELECT e.id FROM expenses e 
                 LEFT JOIN space_members sm ON e.space_id = sm.space_id 
                 WHERE e.id = %s AND (e.user_id = %s OR sm.user_id = %s)
             ''', (expense_id, user_id, user_id))
         
-        permission_check = cursor.fetchone()
-        print(f"🔐 Permission check: {permission_check}")
+            permission_check = cursor.fetchone()
+            print(f"🔐 Permission check: {permission_check}")
         
-        if not permission_check:
-            conn.close()
-            print(f"❌ ERROR: User {user_id} has no permission to delete expense {expense_id}")
-            return jsonify({'error': 'Нет прав для удаления этой траты'}), 403
+            if not permission_check:
+                print(f"❌ ERROR: User {user_id} has no permission to delete expense {expense_id}")
+                return jsonify({'error': 'Нет прав для удаления этой траты'}), 403
         
-        # УДАЛЕНИЕ
-        if isinstance(conn, sqlite3.Connection):
-            cursor.execute('DELETE FROM expenses WHERE id = ?', (expense_id,))
-        else:
+            # УДАЛЕНИЕ
             cursor.execute('DELETE FROM expenses WHERE id = %s', (expense_id,))
         
-        deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
+            deleted_count = cursor.rowcount
+            conn.commit()
         
         if deleted_count > 0:
             print(f"✅ SUCCESS: Expense {expense_id} deleted by user {user_id}")
@@ -2539,39 +2604,17 @@ def api_get_user_spaces():
         user_id = user_data['id']
         logger.info(f"👤 Получение пространств для пользователя: {user_id}")
         
-        conn = get_db_connection()
-        
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT fs.id, fs.name, fs.description, fs.space_type, fs.invite_code,
-                              COUNT(DISTINCT sm.user_id) as member_count
-                       FROM financial_spaces fs
-                       JOIN space_members sm ON fs.id = sm.space_id
-                       WHERE sm.user_id = ? AND fs.is_active = TRUE
-                       GROUP BY fs.id
-                       ORDER BY fs.space_type, fs.created_at DESC'''
-            df = pd.read_sql_query(query, conn, params=(user_id,))
-        else:
-            query = '''SELECT fs.id, fs.name, fs.description, fs.space_type, fs.invite_code,
-                              COUNT(DISTINCT sm.user_id) as member_count
-                       FROM financial_spaces fs
-                       JOIN space_members sm ON fs.id = sm.space_id
-                       WHERE sm.user_id = %s AND fs.is_active = TRUE
-                       GROUP BY fs.id
-                       ORDER BY fs.space_type, fs.created_at DESC'''
-            df = pd.read_sql_query(query, conn, params=(user_id,))
-        
-        conn.close()
-        
-        spaces = []
-        for _, row in df.iterrows():
-            spaces.append({
-                'id': int(row['id']),
-                'name': row['name'],
-                'description': row['description'],
-                'space_type': row['space_type'],
-                'invite_code': row['invite_code'],
-                'member_count': int(row['member_count']) if row['member_count'] else 1
-            })
+        spaces = [
+            {
+                'id': space_id,
+                'name': name,
+                'description': description,
+                'space_type': space_type,
+                'invite_code': invite_code,
+                'member_count': member_count or 1
+            }
+            for space_id, name, description, space_type, invite_code, member_count in list_user_spaces(user_id)
+        ]
         
         logger.info(f"✅ Найдено пространств: {len(spaces)}")
         return jsonify({'spaces': spaces})
@@ -2593,37 +2636,21 @@ def debug_user_membership():
         user_data = get_user_from_init_data(init_data)
         user_id = user_data['id']
         
-        conn = get_db_connection()
-        
-        # 1. Проверим все пространства пользователя
-        if isinstance(conn, sqlite3.Connection):
-            members_query = '''SELECT sm.space_id, sm.role, fs.name, fs.is_active 
-                              FROM space_members sm
-                              JOIN financial_spaces fs ON sm.space_id = fs.id
-                              WHERE sm.user_id = ?'''
-            members_df = pd.read_sql_query(members_query, conn, params=(user_id,))
-        else:
+        with get_db_connection() as conn:
+            # 1. Проверим все пространства пользователя
             members_query = '''SELECT sm.space_id, sm.role, fs.name, fs.is_active 
                               FROM space_members sm
                               JOIN financial_spaces fs ON sm.space_id = fs.id
                               WHERE sm.user_id = %s'''
             members_df = pd.read_sql_query(members_query, conn, params=(user_id,))
         
-        # 2. Проверим конкретное пространство "Семья" (ID: 1)
-        if isinstance(conn, sqlite3.Connection):
-            family_query = '''SELECT fs.id, fs.name, fs.is_active, 
-                             (SELECT COUNT(*) FROM space_members WHERE space_id = fs.id AND user_id = ?) as is_member
-                             FROM financial_spaces fs 
-                             WHERE fs.id = ?'''
-            family_df = pd.read_sql_query(family_query, conn, params=(user_id, 1))
-        else:
+            # 2. Проверим конкретное пространство "Семья" (ID: 1)
             family_query = '''SELECT fs.id, fs.name, fs.is_active, 
                              (SELECT COUNT(*) FROM space_members WHERE space_id = fs.id AND user_id = %s) as is_member
                              FROM financial_spaces fs 
                              WHERE fs.id = %s'''
             family_df = pd.read_sql_query(family_query, conn, params=(user_id, 1))
         
-        conn.close()
         
         return jsonify({
             'user_id': user_id,
@@ -2665,41 +2692,15 @@ def api_get_space_members():
         if not is_user_in_space(user_data['id'], space_id):
             return jsonify({'error': 'Access denied'}), 403
         
-        conn = get_db_connection()
-        
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT user_id, user_name, role, joined_at 
-                       FROM space_members 
-                       WHERE space_id = ?
-                       ORDER BY 
-                         CASE role 
-                           WHEN 'owner' THEN 1 
-                           WHEN 'admin' THEN 2 
-                           ELSE 3 
-                         END, joined_at'''
-            df = pd.read_sql_query(query, conn, params=(space_id,))
-        else:
-            query = '''SELECT user_id, user_name, role, joined_at 
-                       FROM space_members 
-                       WHERE space_id = %s
-                       ORDER BY 
-                         CASE role 
-                           WHEN 'owner' THEN 1 
-                           WHEN 'admin' THEN 2 
-                           ELSE 3 
-                         END, joined_at'''
-            df = pd.read_sql_query(query, conn, params=(space_id,))
-        
-        conn.close()
-        
-        members = []
-        for _, row in df.iterrows():
-            members.append({
-                'user_id': int(row['user_id']),
-                'user_name': row['user_name'],
-                'role': row['role'],
-                'joined_at': row['joined_at'].isoformat() if hasattr(row['joined_at'], 'isoformat') else str(row['joined_at'])
-            })
+        members = [
+            {
+                'user_id': member_id,
+                'user_name': user_name,
+                'role': role,
+                'joined_at': joined_at.isoformat() if hasattr(joined_at, 'isoformat') else str(joined_at)
+            }
+            for member_id, user_name, role, joined_at in list_space_members(space_id)
+        ]
         
         return jsonify({'members': members})
         
@@ -2791,27 +2792,18 @@ def api_delete_space():
             return jsonify({'error': 'Missing space ID'}), 400
         
         # Проверяем права владельца
-        conn = get_db_connection()
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT role FROM space_members WHERE space_id = ? AND user_id = ?'''
-            df = pd.read_sql_query(query, conn, params=(space_id, user_data['id']))
-        else:
+        with get_db_connection() as conn:
             query = '''SELECT role FROM space_members WHERE space_id = %s AND user_id = %s'''
             df = pd.read_sql_query(query, conn, params=(space_id, user_data['id']))
         
-        if df.empty or df.iloc[0]['role'] != 'owner':
-            return jsonify({'error': 'Только владелец может удалить пространство'}), 403
+            if df.empty or df.iloc[0]['role'] != 'owner':
+                return jsonify({'error': 'Только владелец может удалить пространство'}), 403
         
-        # Мягкое удаление - помечаем как неактивное
-        if isinstance(conn, sqlite3.Connection):
-            c = conn.cursor()
-            c.execute('UPDATE financial_spaces SET is_active = FALSE WHERE id = ?', (space_id,))
-        else:
+            # Мягкое удаление - помечаем как неактивное
             c = conn.cursor()
             c.execute('UPDATE financial_spaces SET is_active = FALSE WHERE id = %s', (space_id,))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         
         return jsonify({'success': True, 'message': 'Пространство удалено'})
         
@@ -2847,15 +2839,12 @@ def api_add_expense():
         if not amount or not category or not space_id:
             return jsonify({'error': 'Missing required fields'}), 400
         
-        # Проверяем, что пользователь состоит в пространстве
-        if not is_user_in_space(user_data['id'], space_id):
-            return jsonify({'error': 'Access denied'}), 403
-        
-        # Добавляем трату
-        add_expense(
+        # Добавляем трату; членство в пространстве проверяется тем же запросом
+        if not add_expense_if_member(
             user_data['id'], user_data['first_name'],
             float(amount), category, description, int(space_id), currency
-        )
+        ):
+            return jsonify({'error': 'Access denied'}), 403
         
         return jsonify({'success': True})
             
@@ -2888,92 +2877,26 @@ def api_get_analytics():
         if not is_user_in_space(user_data['id'], space_id):
             return jsonify({'error': 'Access denied'}), 403
         
-        conn = get_db_connection()
-        
-        # Получаем участников пространства для фильтра
-        if isinstance(conn, sqlite3.Connection):
-            users_query = '''SELECT DISTINCT user_id, user_name FROM space_members WHERE space_id = ?'''
-            users_df = pd.read_sql_query(users_query, conn, params=(space_id,))
-        else:
-            users_query = '''SELECT DISTINCT user_id, user_name FROM space_members WHERE space_id = %s'''
-            users_df = pd.read_sql_query(users_query, conn, params=(space_id,))
-        
-        users = []
-        for _, row in users_df.iterrows():
-            users.append({
-                'id': int(row['user_id']),
-                'name': row['user_name']
-            })
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            
+            # Получаем участников пространства для фильтра
+            c.execute('''SELECT DISTINCT user_id, user_name FROM space_members WHERE space_id = %s''',
+                      (space_id,))
+            users = [{'id': int(uid), 'name': name} for uid, name in c.fetchall()]
         
-        # Статистика по категориям
-        if user_id:
-            if isinstance(conn, sqlite3.Connection):
-                query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
-                           FROM expenses 
-                           WHERE space_id = ? AND user_id = ?
-                           GROUP BY category 
-                           ORDER BY total DESC'''
-                df = pd.read_sql_query(query, conn, params=(space_id, user_id))
-                
-                count_query = '''SELECT COUNT(*) as total_count FROM expenses WHERE space_id = ? AND user_id = ?'''
-                count_df = pd.read_sql_query(count_query, conn, params=(space_id, user_id))
-                
-                # Получаем общую сумму для бюджета
-                total_spent_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent FROM expenses WHERE space_id = ? AND user_id = ? AND strftime('%Y-%m', date) = strftime('%Y-%m', 'now')'''
-                total_spent_df = pd.read_sql_query(total_spent_query, conn, params=(space_id, user_id))
-            else:
-                query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
-                           FROM expenses 
-                           WHERE space_id = %s AND user_id = %s
-                           GROUP BY category 
-                           ORDER BY total DESC'''
-                df = pd.read_sql_query(query, conn, params=(space_id, user_id))
-                
-                count_query = '''SELECT COUNT(*) as total_count FROM expenses WHERE space_id = %s AND user_id = %s'''
-                count_df = pd.read_sql_query(count_query, conn, params=(space_id, user_id))
-                
-                total_spent_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent FROM expenses WHERE space_id = %s AND user_id = %s AND DATE_TRUNC('month', date) = DATE_TRUNC('month', CURRENT_DATE)'''
-                total_spent_df = pd.read_sql_query(total_spent_query, conn, params=(space_id, user_id))
-        else:
-            if isinstance(conn, sqlite3.Connection):
-                query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
-                           FROM expenses 
-                           WHERE space_id = ?
-                           GROUP BY category 
-                           ORDER BY total DESC'''
-                df = pd.read_sql_query(query, conn, params=(space_id,))
-                
-                count_query = '''SELECT COUNT(*) as total_count FROM expenses WHERE space_id = ?'''
-                count_df = pd.read_sql_query(count_query, conn, params=(space_id,))
-                
-                total_spent_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent FROM expenses WHERE space_id = ? AND strftime('%Y-%m', date) = strftime('%Y-%m', 'now')'''
-                total_spent_df = pd.read_sql_query(total_spent_query, conn, params=(space_id,))
+            # Статистика по категориям - по всему пространству или по одному участнику
+            if user_id:
+                execute_prepared(conn, c, 'analytics_space_user', (space_id, user_id))
             else:
-                query = '''SELECT category, SUM(amount) as total, COUNT(*) as count
-                           FROM expenses 
-                           WHERE space_id = %s
-                           GROUP BY category 
-                           ORDER BY total DESC'''
-                df = pd.read_sql_query(query, conn, params=(space_id,))
-                
-                count_query = '''SELECT COUNT(*) as total_count FROM expenses WHERE space_id = %s'''
-                count_df = pd.read_sql_query(count_query, conn, params=(space_id,))
-                
-                total_spent_query = '''SELECT COALESCE(SUM(amount), 0) as total_spent FROM expenses WHERE space_id = %s AND DATE_TRUNC('month', date) = DATE_TRUNC('month', CURRENT_DATE)'''
-                total_spent_df = pd.read_sql_query(total_spent_query, conn, params=(space_id,))
-        
-        conn.close()
-        
-        categories = []
-        for _, row in df.iterrows():
-            categories.append({
-                'name': row['category'],
-                'total': float(row['total']),
-                'count': int(row['count'])
-            })
-        
-        total_count = int(count_df.iloc[0]['total_count']) if not count_df.empty else 0
-        total_spent = float(total_spent_df.iloc[0]['total_spent']) if not total_spent_df.empty else 0
+                execute_prepared(conn, c, 'analytics_space', (space_id,))
+            rows = c.fetchall()
+            categories = [
+                {'name': row[0], 'total': float(row[1]), 'count': int(row[2])}
+                for row in rows
+            ]
+            total_count = int(rows[0][3]) if rows else 0
+            total_spent = float(rows[0][4]) if rows else 0
         
         # Получаем бюджет пользователя
         budget, currency = get_user_budget(user_data['id'], space_id)
@@ -3053,71 +2976,30 @@ def api_join_space():
             logger.warning("❌ No invite code provided")
             return jsonify({'error': 'Missing invite code'}), 400
         
-        conn = get_db_connection()
-        logger.info("✅ Database connected")
-        
-        # Находим пространство по коду
-        if isinstance(conn, sqlite3.Connection):
-            space_query = '''SELECT id, name, space_type FROM financial_spaces WHERE invite_code = ? AND is_active = TRUE'''
-            space_df = pd.read_sql_query(space_query, conn, params=(invite_code,))
-        else:
-            space_query = '''SELECT id, name, space_type FROM financial_spaces WHERE invite_code = %s AND is_active = TRUE'''
-            space_df = pd.read_sql_query(space_query, conn, params=(invite_code,))
+        invite_code = str(invite_code).strip().upper()
+        if not is_valid_invite_code(invite_code):
+            logger.warning(f"❌ Malformed invite code: {invite_code}")
+            return jsonify({'error': 'Неверный код приглашения или пространство не существует'}), 404
         
-        logger.info(f"🔍 Found spaces: {len(space_df)}")
+        space, joined = join_space_by_invite(invite_code, user_data['id'], user_data['first_name'])
         
-        if space_df.empty:
+        if space is None:
             logger.warning(f"❌ Space not found for code: {invite_code}")
             return jsonify({'error': 'Неверный код приглашения или пространство не существует'}), 404
         
-        space_id = int(space_df.iloc[0]['id'])  # Конвертируем в int
-        space_name = str(space_df.iloc[0]['name'])  # Конвертируем в string
-        space_type = str(space_df.iloc[0]['space_type'])  # Конвертируем в string
-        
-        logger.info(f"🏠 Space found: {space_name} (ID: {space_id})")
+        space_id, space_name, space_type = space
         
-        # Проверяем, не состоит ли пользователь уже в пространстве
-        if isinstance(conn, sqlite3.Connection):
-            member_query = '''SELECT 1 FROM space_members WHERE space_id = ? AND user_id = ?'''
-            member_df = pd.read_sql_query(member_query, conn, params=(space_id, user_data['id']))
+        if joined:
+            logger.info(f"✅ User {user_data['id']} joined space {space_id}")
         else:
-            member_query = '''SELECT 1 FROM space_members WHERE space_id = %s AND user_id = %s'''
-            member_df = pd.read_sql_query(member_query, conn, params=(space_id, user_data['id']))
-        
-        if not member_df.empty:
             logger.info(f"ℹ️ User {user_data['id']} already in space {space_id} - returning success")
-            # Вместо ошибки возвращаем успех
-            return jsonify({
-                'success': True,
-                'space_id': space_id,
-                'space_name': space_name,
-                'space_type': space_type,
-                'already_member': True  # Флаг что пользователь уже был участником
-            })
-        
-        # Добавляем пользователя в пространство
-        if isinstance(conn, sqlite3.Connection):
-            c = conn.cursor()
-            c.execute('''INSERT INTO space_members (space_id, user_id, user_name, role)
-                         VALUES (?, ?, ?, ?)''', 
-                     (space_id, user_data['id'], user_data['first_name'], 'member'))
-        else:
-            c = conn.cursor()
-            c.execute('''INSERT INTO space_members (space_id, user_id, user_name, role)
-                         VALUES (%s, %s, %s, %s)''', 
-                     (space_id, user_data['id'], user_data['first_name'], 'member'))
-        
-        conn.commit()
-        conn.close()
-        
-        logger.info(f"✅ User {user_data['id']} joined space {space_id}")
         
         return jsonify({
             'success': True,
             'space_id': space_id,
             'space_name': space_name,
             'space_type': space_type,
-            'already_member': False
+            'already_member': not joined  # Флаг что пользователь уже был участником
         })
         
     except Exception as e:
@@ -3133,16 +3015,10 @@ def debug_space_status():
         data = request.json
         space_id = data.get('spaceId')
         
-        conn = get_db_connection()
-        
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT id, name, is_active, invite_code FROM financial_spaces WHERE id = ?'''
-            space_df = pd.read_sql_query(query, conn, params=(space_id,))
-        else:
+        with get_db_connection() as conn:
             query = '''SELECT id, name, is_active, invite_code FROM financial_spaces WHERE id = %s'''
             space_df = pd.read_sql_query(query, conn, params=(space_id,))
         
-        conn.close()
         
         if space_df.empty:
             return jsonify({'error': 'Space not found'}), 404
@@ -3158,6 +3034,14 @@ def debug_space_status():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# HTTP-статус для отказов remove_member_from_space
+REMOVE_MEMBER_ERROR_STATUS = {
+    "Недостаточно прав": 403,
+    "Участник не найден": 404,
+    "Нельзя удалить владельца": 409,
+    "Ошибка при удалении": 500,
+}
+
 @flask_app.route('/remove_member', methods=['POST'])
 def api_remove_member():
     """API для удаления участника из пространства"""
@@ -3182,15 +3066,16 @@ def api_remove_member():
         if not space_id or not target_user_id:
             return jsonify({'error': 'Missing required fields'}), 400
         
-        # Проверяем права администратора
-        if not is_user_admin_in_space(user_data['id'], space_id):
-            return jsonify({'error': 'Недостаточно прав'}), 403
-        
-        # Нельзя удалить самого себя
+        # Нельзя удалить самого себя; отказ по правам важнее, поэтому не-админ получает 403
         if user_data['id'] == target_user_id:
+            if not is_user_admin_in_space(user_data['id'], space_id):
+                return jsonify({'error': 'Недостаточно прав'}), 403
             return jsonify({'error': 'Нельзя удалить самого себя'}), 400
         
+        # Права администратора проверяются внутри удаления
         success, message = remove_member_from_space(space_id, target_user_id, user_data['id'])
+        if not success:
+            return jsonify({'success': False, 'error': message}), REMOVE_MEMBER_ERROR_STATUS.get(message, 500)
         
         return jsonify({'success': success, 'message': message})
         
@@ -3216,17 +3101,7 @@ def api_delete_user_category():
         if not category_name:
             return jsonify({'error': 'Category name is required'}), 400
         
-        conn = get_db_connection()
-        
-        if isinstance(conn, sqlite3.Connection):
-            # Удаляем категорию только если она пользовательская и принадлежит этому пользователю
-            result = conn.execute('''DELETE FROM user_categories 
-                                   WHERE user_id = ? AND (space_id = ? OR space_id = 0) 
-                                   AND category_name = ? AND is_custom = TRUE''',
-                                (user_data['id'], space_id if space_id else 0, category_name))
-            
-            deleted_count = result.rowcount
-        else:
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM user_categories 
                            WHERE user_id = %s AND (space_id = %s OR space_id = 0) 
@@ -3235,8 +3110,7 @@ def api_delete_user_category():
             
             deleted_count = cursor.rowcount
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         
         if deleted_count > 0:
             return jsonify({'success': True, 'message': 'Категория удалена'})
@@ -3252,20 +3126,19 @@ def api_delete_user_category():
 def debug_postgres():
     """Проверка подключения к PostgreSQL"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Проверяем данные
-        cursor.execute("SELECT COUNT(*) as spaces_count FROM financial_spaces")
-        spaces_count = cursor.fetchone()[0]
+            # Проверяем данные
+            cursor.execute("SELECT COUNT(*) as spaces_count FROM financial_spaces")
+            spaces_count = cursor.fetchone()[0]
         
-        cursor.execute("SELECT COUNT(*) as expenses_count FROM expenses")
-        expenses_count = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) as expenses_count FROM expenses")
+            expenses_count = cursor.fetchone()[0]
         
-        cursor.execute("SELECT name FROM financial_spaces LIMIT 5")
-        spaces = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT name FROM financial_spaces LIMIT 5")
+            spaces = [row[0] for row in cursor.fetchall()]
         
-        conn.close()
         
         return jsonify({
             "status": "success",
@@ -3282,46 +3155,24 @@ def debug_postgres():
             "error": str(e)
         }), 500
 # ===== TELEGRAM BOT HANDLERS (СОХРАНЕНЫ БЕЗ ИЗМЕНЕНИЙ) =====
-async def check_if_new_user(user_id: int) -> bool:
-    """Проверяет, новый ли пользователь"""
-    conn = get_db_connection()
-    try:
-        if isinstance(conn, sqlite3.Connection):
-            query = '''SELECT COUNT(*) as count FROM space_members WHERE user_id = ?'''
-            result = pd.read_sql_query(query, conn, params=(user_id,))
-        else:
-            query = '''SELECT COUNT(*) as count FROM space_members WHERE user_id = %s'''
-            result = pd.read_sql_query(query, conn, params=(user_id,))
-        
-        count = result.iloc[0]['count']
-        return count == 0  # Если нет записей - новый пользователь
-    except Exception as e:
-        logger.error(f"❌ Error checking if user is new: {e}")
-        return True  # В случае ошибки считаем новым
-    finally:
-        conn.close()
-
-
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     # ДИАГНОСТИКА
-    print(f"=== 🚀 START COMMAND CALLED ===")
-    print(f"👤 User: {user.id} - {user.first_name}")
+    logger.debug("🚀 /start от пользователя %s - %s", user.id, user.first_name)
     
     # Проверяем, это приглашение или обычный старт
     args = context.args
     if args and args[0].startswith('invite_'):
-        print(f"🎯 Invite detected: {args[0]}")
+        logger.info("🎯 Приглашение в /start: %s", args[0])
         await handle_invite_start(update, context)
         return
     
     # Получаем реальную статистику пользователя
-    spaces_count, total_expenses, last_expense_amount = await get_user_statistics(user.id)
+    spaces_count, total_expenses, last_expense_amount = await run_db(get_user_statistics, user.id)
     
-    # Проверяем новый ли пользователь
-    is_new_user = await check_if_new_user(user.id)
+    # Новый пользователь - тот, кто еще не состоит ни в одном пространстве
+    is_new_user = spaces_count == 0
     
     if is_new_user:
         welcome_text = (
@@ -3356,14 +3207,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     else:
         # Динамическая статистика
-        stats_text = f"💫 <b>Ваша финансовая статистика:</b>\n"
-        stats_text += f"• 🏠 Пространств: {spaces_count} активных\n"
-        stats_text += f"• 📈 Трат за все время: {total_expenses} операций\n"
+        stats_parts = [
+            "💫 <b>Ваша финансовая статистика:</b>\n",
+            f"• 🏠 Пространств: {spaces_count} активных\n",
+            f"• 📈 Трат за все время: {total_expenses} операций\n",
+        ]
         
         if last_expense_amount > 0:
-            stats_text += f"• 💰 Последняя трата: {last_expense_amount} руб\n\n"
+            stats_parts.append(f"• 💰 Последняя трата: {last_expense_amount} руб\n\n")
         else:
-            stats_text += f"• 💰 Последняя трата: пока нет трат\n\n"
+            stats_parts.append("• 💰 Последняя трата: пока нет трат\n\n")
+        stats_text = "".join(stats_parts)
         
         welcome_text = (
             f"С возвращением, {user.first_name}! 👋\n\n"
@@ -3381,80 +3235,52 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     # ОТПРАВЛЯЕМ СООБЩЕНИЕ БЕЗ КЛАВИАТУРЫ
-    print(f"📨 Sending welcome message to user {user.id} (no keyboard)")
     await update.message.reply_text(
         welcome_text,
         parse_mode='HTML'
     )
-    print("✅ Welcome message sent successfully (no keyboard)")
+    logger.debug("✅ Приветствие отправлено пользователю %s", user.id)
 
-async def get_user_statistics(user_id):
-    """Получает реальную статистику пользователя"""
-    conn = get_db_connection()
+_Q_USER_STATISTICS = '''SELECT
+        (SELECT COUNT(DISTINCT space_id) FROM space_members WHERE user_id = %s),
+        (SELECT COUNT(*) FROM expenses WHERE user_id = %s),
+        (SELECT amount FROM expenses WHERE user_id = %s ORDER BY date DESC LIMIT 1)'''
+
+def get_user_statistics(user_id):
+    """Получает реальную статистику пользователя одним запросом:
+    (пространств, трат всего, сумма последней траты)
+    """
     try:
-        if isinstance(conn, sqlite3.Connection):
-            # Количество пространств
-            spaces_query = '''SELECT COUNT(DISTINCT space_id) as spaces_count 
-                            FROM space_members WHERE user_id = ?'''
-            spaces_df = pd.read_sql_query(spaces_query, conn, params=(user_id,))
-            
-            # Общее количество трат
-            expenses_query = '''SELECT COUNT(*) as total_expenses 
-                              FROM expenses WHERE user_id = ?'''
-            expenses_df = pd.read_sql_query(expenses_query, conn, params=(user_id,))
-            
-            # Последняя трата
-            last_expense_query = '''SELECT amount FROM expenses 
-                                  WHERE user_id = ? 
-                                  ORDER BY date DESC LIMIT 1'''
-            last_expense_df = pd.read_sql_query(last_expense_query, conn, params=(user_id,))
-        else:
-            # PostgreSQL версия
-            spaces_query = '''SELECT COUNT(DISTINCT space_id) as spaces_count 
-                            FROM space_members WHERE user_id = %s'''
-            spaces_df = pd.read_sql_query(spaces_query, conn, params=(user_id,))
-            
-            expenses_query = '''SELECT COUNT(*) as total_expenses 
-                              FROM expenses WHERE user_id = %s'''
-            expenses_df = pd.read_sql_query(expenses_query, conn, params=(user_id,))
-            
-            last_expense_query = '''SELECT amount FROM expenses 
-                                  WHERE user_id = %s 
-                                  ORDER BY date DESC LIMIT 1'''
-            last_expense_df = pd.read_sql_query(last_expense_query, conn, params=(user_id,))
-        
-        spaces_count = spaces_df.iloc[0]['spaces_count'] if not spaces_df.empty else 0
-        total_expenses = expenses_df.iloc[0]['total_expenses'] if not expenses_df.empty else 0
-        last_expense_amount = last_expense_df.iloc[0]['amount'] if not last_expense_df.empty else 0
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute(_Q_USER_STATISTICS, (user_id, user_id, user_id))
+            spaces_count, total_expenses, last_expense_amount = c.fetchone()
         
-        return spaces_count, total_expenses, last_expense_amount
+        return spaces_count, total_expenses, last_expense_amount or 0
         
     except Exception as e:
-        logger.error(f"❌ Error getting user statistics: {e}")
+        logger.exception("❌ Error getting user statistics: %s", e)
         return 0, 0, 0
-    finally:
-        conn.close()
 
 async def test_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Тестовая команда для проверки приветствия"""
     await start(update, context)
 
+def count_user_memberships(user_id):
+    """Сколько записей space_members у пользователя"""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''SELECT COUNT(*) FROM space_members WHERE user_id = %s''', (user_id,))
+        return c.fetchone()[0]
+
 async def debug_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Диагностическая команда"""
     user = update.effective_user
     user_id = user.id
     
-    conn = get_db_connection()
     try:
-        if isinstance(conn, sqlite3.Connection):
-            # Проверяем space_members
-            query = '''SELECT COUNT(*) as count FROM space_members WHERE user_id = ?'''
-            result = pd.read_sql_query(query, conn, params=(user_id,))
-        else:
-            query = '''SELECT COUNT(*) as count FROM space_members WHERE user_id = %s'''
-            result = pd.read_sql_query(query, conn, params=(user_id,))
-        
-        count = result.iloc[0]['count']
+        # Проверяем space_members
+        count = await run_db(count_user_memberships, user_id)
         
         await update.message.reply_text(
             f"🔍 <b>Диагностика пользователя</b>\n\n"
@@ -3467,13 +3293,37 @@ async def debug_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка диагностики: {e}")
-    finally:
-        conn.close()
         
 
 
 
         
+def join_space_by_invite(invite_code, user_id, user_name):
+    """Добавляет пользователя в пространство по коду приглашения.
+    
+    Возвращает ((id, название, тип) пространства, добавлен ли сейчас);
+    для неверного кода - (None, False).
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        # Пространство и членство пользователя - одним запросом
+        c.execute(_Q_SPACE_BY_INVITE, (user_id, invite_code))
+        row = c.fetchone()
+        
+        if row is None:
+            return None, False
+        
+        space = (int(row[0]), row[1], row[2])
+        if row[3]:
+            return space, False
+        
+        # Добавляем пользователя
+        c.execute('''INSERT INTO space_members (space_id, user_id, user_name, role)
+                      VALUES (%s, %s, %s, %s)''', 
+                  (space[0], user_id, user_name, 'member'))
+        conn.commit()
+        return space, True
+
 async def handle_invite_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка пригласительных ссылок с улучшенным приветствием"""
     user = update.effective_user
@@ -3482,74 +3332,53 @@ async def handle_invite_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     if args and args[0].startswith('invite_'):
         invite_code = args[0].replace('invite_', '')
         
+        if not is_valid_invite_code(invite_code):
+            await update.message.reply_text("❌ Неверная ссылка приглашения")
+            return
+        
         # Проверяем код и добавляем пользователя
-        conn = get_db_connection()
         try:
-            if isinstance(conn, sqlite3.Connection):
-                space_query = '''SELECT id, name FROM financial_spaces WHERE invite_code = ? AND is_active = TRUE'''
-                space_df = pd.read_sql_query(space_query, conn, params=(invite_code,))
-            else:
-                space_query = '''SELECT id, name FROM financial_spaces WHERE invite_code = %s AND is_active = TRUE'''
-                space_df = pd.read_sql_query(space_query, conn, params=(invite_code,))
+            space, joined = await run_db(join_space_by_invite, invite_code, user.id, user.first_name)
             
-            if not space_df.empty:
-                space_id = space_df.iloc[0]['id']
-                space_name = space_df.iloc[0]['name']
-                
-                # Проверяем, не состоит ли уже пользователь
-                if isinstance(conn, sqlite3.Connection):
-                    member_query = '''SELECT 1 FROM space_members WHERE space_id = ? AND user_id = ?'''
-                    member_df = pd.read_sql_query(member_query, conn, params=(space_id, user.id))
-                else:
-                    member_query = '''SELECT 1 FROM space_members WHERE space_id = %s AND user_id = %s'''
-                    member_df = pd.read_sql_query(member_query, conn, params=(space_id, user.id))
-                
-                if member_df.empty:
-                    # Добавляем пользователя
-                    if isinstance(conn, sqlite3.Connection):
-                        c = conn.cursor()
-                        c.execute('''INSERT INTO space_members (space_id, user_id, user_name, role)
-                                     VALUES (?, ?, ?, ?)''', 
-                                 (space_id, user.id, user.first_name, 'member'))
-                    else:
-                        c = conn.cursor()
-                        c.execute('''INSERT INTO space_members (space_id, user_id, user_name, role)
-                                     VALUES (%s, %s, %s, %s)''', 
-                                 (space_id, user.id, user.first_name, 'member'))
-                    conn.commit()
-                    
-                    # УЛУЧШЕННОЕ ПРИВЕТСТВИЕ ДЛЯ ПРИГЛАШЕННЫХ
-                    welcome_text = (
-                        f"🎉 Поздравляем, {user.first_name}!\n\n"
-                        f"✅ Вы успешно присоединились к пространству: <b>{space_name}</b>\n\n"
-                        "Теперь вы можете:\n"
-                        "• 📊 Видеть общие траты участников\n"
-                        "• 💸 Добавлять свои расходы\n"
-                        "• 📈 Следить за общей статистикой\n"
-                        "• 🎯 Участвовать в бюджетировании\n\n"
-                        "Нажмите кнопку ниже, чтобы открыть финансовый трекер и начать работу!"
-                    )
-                else:
-                    welcome_text = f"ℹ️ Вы уже состоите в пространстве: <b>{space_name}</b>"
-                
-                await update.message.reply_text(
-                    welcome_text,
-                    reply_markup=ReplyKeyboardMarkup([
-                        [KeyboardButton("📊 Открыть финансовый трекер", web_app=WebAppInfo(url=WEB_APP_URL))]
-                    ], resize_keyboard=True),
-                    parse_mode='HTML'
+            if space is None:
+                await update.message.reply_text("❌ Неверная ссылка приглашения")
+                return
+            
+            space_name = space[1]
+            if joined:
+                # УЛУЧШЕННОЕ ПРИВЕТСТВИЕ ДЛЯ ПРИГЛАШЕННЫХ
+                welcome_text = (
+                    f"🎉 Поздравляем, {user.first_name}!\n\n"
+                    f"✅ Вы успешно присоединились к пространству: <b>{space_name}</b>\n\n"
+                    "Теперь вы можете:\n"
+                    "• 📊 Видеть общие траты участников\n"
+                    "• 💸 Добавлять свои расходы\n"
+                    "• 📈 Следить за общей статистикой\n"
+                    "• 🎯 Участвовать в бюджетировании\n\n"
+                    "Нажмите кнопку ниже, чтобы открыть финансовый трекер и начать работу!"
                 )
             else:
-                await update.message.reply_text("❌ Неверная ссылка приглашения")
+                welcome_text = f"ℹ️ Вы уже состоите в пространстве: <b>{space_name}</b>"
+            
+            await update.message.reply_text(
+                welcome_text,
+                reply_markup=WEB_APP_KEYBOARD,
+                parse_mode='HTML'
+            )
                 
         except Exception as e:
-            logger.error(f"❌ Ошибка обработки приглашения: {e}")
+            logger.exception("❌ Ошибка обработки приглашения: %s", e)
             await update.message.reply_text("❌ Ошибка при присоединении к пространству")
-        finally:
-            conn.close()
     else:
         await start(update, context)
 
+async def get_user_personal_space_id(user):
+    """ID активного личного пространства (создается при необходимости).
+    
+    Между сообщениями не кэшируется: владелец может удалить пространство через API.
+    """
+    return await run_db(ensure_user_has_personal_space, user.id, user.first_name)
+
 async def handle_web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка данных из веб-приложения"""
     try:
@@ -3565,7 +3394,8 @@ async def handle_web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE
             category = parsed_data.get('category')
             description = parsed_data.get('description', '')
             
-            add_expense(user.id, user.first_name, amount, category, description)
+            space_id = await get_user_personal_space_id(user)
+            enqueue_expense(user.id, user.first_name, amount, category, description, space_id)
             
             await update.message.reply_text(
                 f"✅ Трата добавлена!\n"
@@ -3575,28 +3405,69 @@ async def handle_web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             
     except Exception as e:
-        logger.error(f"❌ Ошибка обработки данных веб-приложения: {e}")
+        logger.exception("❌ Ошибка обработки данных веб-приложения: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при обработке данных")
 
 
+# Фото и голосовые, доставленные позже этого, не обрабатываем
+MEDIA_MAX_AGE = timedelta(seconds=int(os.environ.get('MEDIA_MAX_AGE', 120)))
+
+_stale_media_replies = set()  # ответы на отброшенные сообщения, пока они отправляются
+
+def is_stale_media(update: Update):
+    """Фото/голосовое, которое Telegram доставил позже MEDIA_MAX_AGE после отправки"""
+    message = update.message
+    if message is None:
+        return False
+    if not ((message.photo and TESSERACT_AVAILABLE) or (message.voice and VOICE_AVAILABLE)):
+        return False
+    return datetime.now(timezone.utc) - message.date > MEDIA_MAX_AGE
+
+async def reply_stale_media(update: Update):
+    """Просит пользователя отправить отброшенное фото/голосовое еще раз"""
+    try:
+        await update.message.reply_text("⏳ Сообщение пришло с опозданием, пожалуйста, отправьте его еще раз")
+    except Exception as e:
+        logger.error("❌ Не удалось ответить на устаревшее сообщение %s: %s", update.update_id, e)
+
+class UpdateQueue(asyncio.Queue):
+    """Очередь обновлений бота: устаревшие фото и голосовые отсекаются при поступлении.
+    
+    Возраст проверяется до постановки в очередь: ожидание в самой очереди
+    при нагрузке не должно делать свежие сообщения устаревшими.
+    """
+    
+    def put_nowait(self, item):
+        if isinstance(item, Update) and is_stale_media(item):
+            age = datetime.now(timezone.utc) - item.message.date
+            logger.warning("⏳ Пропуск устаревшего обновления %s (%.0f с)", item.update_id, age.total_seconds())
+            task = asyncio.get_running_loop().create_task(reply_stale_media(item))
+            _stale_media_replies.add(task)
+            task.add_done_callback(_stale_media_replies.discard)
+            return
+        super().put_nowait(item)
+
+RECEIPT_PHOTO_MAX_WIDTH = 1600  # px
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка фото с чеком"""
-    user = update.effective_user
-    
     try:
-        # Получаем фото
-        photo_file = await update.message.photo[-1].get_file()
+        if not TESSERACT_AVAILABLE:
+            # Без OCR фото даже не скачиваем
+            await update.message.reply_text(
+                "❌ Не удалось распознать сумму чека. "
+                "Пожалуйста, добавьте трату вручную через веб-приложение."
+            )
+            return
         
-        # Создаем временный файл
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-            await photo_file.download_to_drive(temp_file.name)
-            
-            # Читаем байты
-            with open(temp_file.name, 'rb') as f:
-                image_bytes = f.read()
+        # Берем самый крупный размер не шире RECEIPT_PHOTO_MAX_WIDTH:
+        # время OCR растет с числом пикселей, а цифры чека читаются и так
+        photos = update.message.photo
+        photo = next((p for p in reversed(photos) if p.width <= RECEIPT_PHOTO_MAX_WIDTH), photos[0])
+        photo_file = await photo.get_file()
         
-        # Удаляем временный файл
-        os.unlink(temp_file.name)
+        # Скачиваем сразу в память, без временного файла
+        image_bytes = await photo_file.download_as_bytearray()
         
         await update.message.reply_text("🔍 Анализирую чек...")
         
@@ -3611,11 +3482,12 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
             reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
             
-            message_text = f"📄 Чек распознан!\n\n"
+            message_parts = ["📄 Чек распознан!\n\n"]
             if receipt_data['store']:
-                message_text += f"🏪 Магазин: {receipt_data['store']}\n"
-            message_text += f"💰 Сумма: {receipt_data['total']} руб\n\n"
-            message_text += "Добавить эту трату?"
+                message_parts.append(f"🏪 Магазин: {receipt_data['store']}\n")
+            message_parts.append(f"💰 Сумма: {receipt_data['total']} руб\n\n")
+            message_parts.append("Добавить эту трату?")
+            message_text = "".join(message_parts)
             
             # Сохраняем данные чека в контексте
             context.user_data['pending_receipt'] = receipt_data
@@ -3628,42 +3500,108 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
     except Exception as e:
-        logger.error(f"❌ Ошибка обработки фото: {e}")
+        logger.exception("❌ Ошибка обработки фото: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при обработке чека")
 
+# Общий распознаватель речи: создается один раз, а не на каждое сообщение.
+# speech_recognition импортируется лениво - воркерам gunicorn с одним API он не нужен
+_sr_recognizer = None
+_sr_recognizer_lock = Lock()
+# Наличие модуля проверяется без импорта
+VOICE_AVAILABLE = ENABLE_VOICE and importlib.util.find_spec('speech_recognition') is not None
+
+def get_speech_recognizer():
+    """Распознаватель речи (создается при первом обращении в процессе)"""
+    global _sr_recognizer
+    if _sr_recognizer is None:
+        with _sr_recognizer_lock:
+            if _sr_recognizer is None:
+                import speech_recognition as sr
+                recognizer = sr.Recognizer()
+                recognizer.energy_threshold = 300
+                recognizer.pause_threshold = 0.5
+                # Динамический порог отключен - он нужен только для записи с микрофона
+                recognizer.dynamic_energy_threshold = False
+                _sr_recognizer = recognizer
+    return _sr_recognizer
+
+def warm_up_media():
+    """Заранее загружает модули OCR и распознавания речи, чтобы первое фото/голосовое не ждало импорта"""
+    if TESSERACT_AVAILABLE:
+        # Модули PIL, которые использует OCR; сами имена здесь не нужны
+        for module in ('PIL.Image', 'PIL.ImageOps', 'PIL.ImageFilter'):
+            importlib.import_module(module)
+    if VOICE_AVAILABLE:
+        get_speech_recognizer()
+    logger.info("🔥 Модули обработки медиа загружены")
+
+VOICE_SAMPLE_RATE = 16000  # Гц, моно 16 бит
+
+# Отдельный ограниченный пул для голосовых: не больше VOICE_WORKERS одновременных
+# запросов к Google Speech, и очередь голосовых не задерживает OCR чеков
+VOICE_WORKERS = 4
+_VOICE_EXECUTOR = ThreadPoolExecutor(max_workers=VOICE_WORKERS, thread_name_prefix='voice')
+
+# Шаблоны разбора голосовой траты (компилируются один раз)
+_VOICE_AMOUNT_RE = re.compile(r'(\d+)\s*(?:руб|р|₽)')
+_VOICE_CATEGORY_RE = re.compile(r'(еда|продукты|транспорт|кафе|развлечения|одежда|другое)')
+
+def decode_voice_to_pcm(voice_bytes):
+    """Декодирование голосового (OGG/Opus) в сырой PCM int16 прямо в памяти"""
+    result = subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0',
+         '-ac', '1', '-ar', str(VOICE_SAMPLE_RATE), '-f', 's16le', 'pipe:1'],
+        input=voice_bytes, capture_output=True, check=True
+    )
+    return result.stdout
+
+def transcribe_voice(voice_bytes):
+    """Распознает голосовое сообщение (OGG) в текст; None, если речь не распознана"""
+    import speech_recognition as sr
+    
+    # Декодируем в PCM без промежуточного WAV-файла
+    pcm = decode_voice_to_pcm(voice_bytes)
+    audio = sr.AudioData(pcm, VOICE_SAMPLE_RATE, 2)
+    try:
+        return get_speech_recognizer().recognize_google(audio, language='ru-RU', show_all=False)
+    except sr.UnknownValueError:
+        return None
+
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка голосовых сообщений"""
     user = update.effective_user
     
     try:
-        voice_file = await update.message.voice.get_file()
-        
-        # Создаем временный файл
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.ogg') as temp_file:
-            await voice_file.download_to_drive(temp_file.name)
+        if not VOICE_AVAILABLE:
+            # Без распознавания голосовое даже не скачиваем
+            await update.message.reply_text("❌ Голосовые сообщения сейчас не обрабатываются")
+            return
         
-        # Распознаем речь
-        r = sr.Recognizer()
-        with sr.AudioFile(temp_file.name) as source:
-            audio = r.record(source)
+        voice_file = await update.message.voice.get_file()
         
-        # Удаляем временный файл
-        os.unlink(temp_file.name)
+        # Скачиваем сразу в память, без временного файла
+        voice_bytes = await voice_file.download_as_bytearray()
         
-        # Распознаем текст
-        text = r.recognize_google(audio, language='ru-RU')
+        # Декодирование и распознавание - вне event loop
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(_VOICE_EXECUTOR, transcribe_voice, voice_bytes)
+        if text is None:
+            await update.message.reply_text("❌ Не удалось распознать речь")
+            return
         
         await update.message.reply_text(f"🎤 Распознано: {text}")
         
         # Простой парсинг для тестирования
-        amount_match = re.search(r'(\d+)\s*(?:руб|р|₽)', text.lower())
-        category_match = re.search(r'(еда|продукты|транспорт|кафе|развлечения|одежда|другое)', text.lower())
+        text_lower = text.lower()
+        amount_match = _VOICE_AMOUNT_RE.search(text_lower)
+        category_match = _VOICE_CATEGORY_RE.search(text_lower)
         
         if amount_match:
             amount = float(amount_match.group(1))
             category = category_match.group(1) if category_match else 'другое'
             
-            add_expense(user.id, user.first_name, amount, category, f"Голосовое: {text}")
+            space_id = await get_user_personal_space_id(user)
+            enqueue_expense(user.id, user.first_name, amount, category, f"Голосовое: {text}", space_id)
             
             await update.message.reply_text(
                 f"✅ Трата добавлена!\n"
@@ -3676,63 +3614,90 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Пожалуйста, используйте формат: '500 рублей на еду'"
             )
             
-    except sr.UnknownValueError:
-        await update.message.reply_text("❌ Не удалось распознать речь")
     except Exception as e:
-        logger.error(f"❌ Ошибка обработки голоса: {e}")
+        logger.exception("❌ Ошибка обработки голоса: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при обработке голосового сообщения")
 
+HELP_TEXT = (
+    "📋 <b>Доступные команды:</b>\n\n"
+    "• Используйте кнопку <b>«Финансовый трекер»</b> в меню бота для доступа ко всем функциям\n"
+    "💫 <b>Возможности:</b>\n"
+    "✅ Учет личных и совместных трат\n"
+    "📊 Аналитика и статистика\n"
+    "🎯 Установка бюджетов\n"
+    "👥 Управление группами\n"
+    "🔔 Умные уведомления о бюджете\n"
+    "📤 Экспорт в Excel"
+)
+
+FALLBACK_TEXT = (
+    "🤖 Я финансовый помощник!\n\n"
+    "Используйте кнопку <b>«Финансовый трекер»</b> в меню бота "
+    "или отправьте мне фото чека для автоматического распознавания."
+)
+
+# Ответы на простые текстовые команды; все остальное получает FALLBACK_TEXT
+TEXT_REPLIES = {
+    'помощь': HELP_TEXT,
+    'help': HELP_TEXT,
+    'команды': HELP_TEXT,
+}
+
+RECEIPT_ADDED_TEMPLATE = (
+    "✅ Трата добавлена!\n"
+    "💸 Сумма: {total} руб\n"
+    "🏪 Магазин: {store}"
+)
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     text = update.message.text
     
     # Обработка подтверждения чека
-    if 'pending_receipt' in context.user_data and text.startswith('✅ Да'):
-        receipt_data = context.user_data['pending_receipt']
-        
-        add_expense(
-            user.id, user.first_name, 
-            receipt_data['total'], 
-            'покупки', 
-            f"Чек: {receipt_data['store'] or 'магазин'}"
-        )
-        
-        await update.message.reply_text(
-            f"✅ Трата добавлена!\n"
-            f"💸 Сумма: {receipt_data['total']} руб\n"
-            f"🏪 Магазин: {receipt_data['store'] or 'не указан'}"
-        )
+    receipt_data = context.user_data.get('pending_receipt')
+    if receipt_data is not None:
+        if text.startswith('✅ Да'):
+            del context.user_data['pending_receipt']
+            enqueue_expense(
+                user.id, user.first_name, 
+                receipt_data['total'], 
+                'покупки', 
+                f"Чек: {receipt_data['store'] or 'магазин'}",
+                await get_user_personal_space_id(user)
+            )
+            await update.message.reply_text(RECEIPT_ADDED_TEMPLATE.format(
+                total=receipt_data['total'],
+                store=receipt_data['store'] or 'не указан'
+            ))
+            return
         
-        del context.user_data['pending_receipt']
-        return
-    
-    elif 'pending_receipt' in context.user_data and text.startswith('❌ Нет'):
-        await update.message.reply_text("❌ Добавление траты отменено")
-        del context.user_data['pending_receipt']
-        return
+        if text.startswith('❌ Нет'):
+            del context.user_data['pending_receipt']
+            await update.message.reply_text("❌ Добавление траты отменено")
+            return
     
-    # Обработка простых команд
-    if text.lower() in ['помощь', 'help', 'команды']:
-        await update.message.reply_text(
-            "📋 <b>Доступные команды:</b>\n\n"
-            "• Используйте кнопку <b>«Финансовый трекер»</b> в меню бота для доступа ко всем функциям\n"
-            "💫 <b>Возможности:</b>\n"
-            "✅ Учет личных и совместных трат\n"
-            "📊 Аналитика и статистика\n"
-            "🎯 Установка бюджетов\n"
-            "👥 Управление группами\n"
-            "🔔 Умные уведомления о бюджете\n"
-            "📤 Экспорт в Excel",
-            parse_mode='HTML'
-        )
-    else:
-        # Простое сообщение без клавиатуры
-        await update.message.reply_text(
-            "🤖 Я финансовый помощник!\n\n"
-            "Используйте кнопку <b>«Финансовый трекер»</b> в меню бота "
-            "или отправьте мне фото чека для автоматического распознавания.",
-            parse_mode='HTML'
-        )
+    # Обработка простых команд; иначе простое сообщение без клавиатуры
+    await update.message.reply_text(TEXT_REPLIES.get(text.lower(), FALLBACK_TEXT), parse_mode='HTML')
+
+# Фильтры обработчиков собираются один раз
+F_WEBAPP = filters.StatusUpdate.WEB_APP_DATA
+F_COMMAND = filters.COMMAND
+F_PHOTO = filters.PHOTO
+F_VOICE = filters.VOICE
+F_TEXT_NONCMD = filters.TEXT & ~filters.COMMAND
+
+# Команды без аргументов: один обработчик и поиск по словарю вместо CommandHandler на каждую
+COMMAND_TABLE = {
+    'test': test_welcome,
+    'debug': debug_user,
+}
+
+async def dispatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Вызывает обработчик команды из COMMAND_TABLE; неизвестные команды игнорируются"""
+    command = update.message.text.split(maxsplit=1)[0][1:].split('@', 1)[0].lower()
+    handler = COMMAND_TABLE.get(command)
+    if handler is not None:
+        await handler(update, context)
 
 # ===== ОСНОВНАЯ ФУНКЦИЯ =====
 def main():
@@ -3741,6 +3706,14 @@ def main():
         logger.error("❌ BOT_TOKEN не найден!")
         return
     
+    # uvloop ускоряет event loop бота; на Windows его нет - остаемся на asyncio
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("⚡ uvloop включен")
+    except ImportError:
+        logger.info("ℹ️ uvloop не установлен, используется стандартный asyncio")
+    
     # ПРИНУДИТЕЛЬНАЯ ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ
     logger.info("🗃️ ПРИНУДИТЕЛЬНАЯ инициализация базы данных...")
     init_db()
@@ -3749,50 +3722,53 @@ def main():
     logger.info("🔍 Проверка создания таблиц...")
     check_tables_exist()
     
+    warm_up_media()
+    
     # Создаем приложение бота
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .connection_pool_size(CONCURRENT_UPDATES)  # Каждому обработчику - свое keep-alive соединение к Bot API
+        .update_queue(UpdateQueue(maxsize=UPDATE_QUEUE_SIZE))
+        .post_init(start_expense_flusher)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
-    # Добавляем обработчики
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("test", test_welcome))
-    application.add_handler(CommandHandler("debug", debug_user))
-    application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_web_app_data))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    # Добавляем обработчики одним вызовом; самые избирательные фильтры - первыми
+    application.add_handlers([
+        MessageHandler(F_WEBAPP, handle_web_app_data),
+        CommandHandler("start", start),  # /start разбирает аргументы приглашения
+        MessageHandler(F_COMMAND, dispatch_command),
+        MessageHandler(F_PHOTO, handle_photo, block=False),
+        MessageHandler(F_VOICE, handle_voice, block=False),
+        MessageHandler(F_TEXT_NONCMD, handle_text),
+    ])
     
     # Запускаем Flask
-    import threading
-    port = int(os.environ.get('PORT', 5000))
-    
     def run_flask():
-        flask_app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
+        flask_app.run(host='0.0.0.0', port=PORT, debug=False, use_reloader=False)
     
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
+    flask_thread = Thread(target=run_flask, daemon=True)
     flask_thread.start()
-    logger.info(f"🌐 Flask API запущен на порту {port}")
+    logger.info(f"🌐 Flask API запущен на порту {PORT}")
     
-    logger.info("🤖 Запуск бота...")
-    application.run_polling()
-    
-    try:
-        # Очищаем предыдущие обновления
-        asyncio.run(application.bot.delete_webhook(drop_pending_updates=True))
-        logger.info("✅ Предыдущие обновления очищены")
-        
-        # Запускаем polling
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            close_loop=False
+    if WEBHOOK_URL:
+        logger.info(f"🤖 Запуск бота (webhook, порт {WEBHOOK_PORT})...")
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=100,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=True
         )
-    except Exception as e:
-        logger.error(f"🔴 Ошибка запуска бота: {e}")
-        logger.info("🔄 Перезапуск через 10 секунд...")
-        time.sleep(10)
-        main()  # Рекурсивный перезапуск
-    except Exception as e:
-        logger.error(f"🔴 Критическая ошибка: {e}")
-        raise
+    else:
+        logger.info("🤖 Запуск бота (polling)...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
 
 if __name__ == '__main__':
     main()